@@ -16,6 +16,10 @@ NODE_CONFIG = {
         "class": NCECosyVoiceZeroShot,
         "name": "🎙️ CosyVoice 3秒音色克隆"
     },
+    "NCECosyVoiceBatch": {
+        "class": NCECosyVoiceBatch,
+        "name": "🎙️ CosyVoice 批量合成"
+    },
     "NCECosyVoiceSaveSpeakerModel": {
         "class": NCECosyVoiceSaveSpeakerModel,
         "name": "🎙️ CosyVoice 保存说话人模型"
@@ -28,6 +32,10 @@ NODE_CONFIG = {
         "class": NCECosyVoiceCrossLingual,
         "name": "🎙️ CosyVoice 跨语言克隆"
     },
+    "NCECosyVoiceUnloadModels": {
+        "class": NCECosyVoiceUnloadModels,
+        "name": "🎙️ CosyVoice 卸载模型"
+    },
 }
 
 def generate_node_mappings(node_config):
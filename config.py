@@ -24,4 +24,30 @@ COSYVOICE_MODEL_DIR       = os.path.join(folder_paths.models_dir, "CosyVoice")
 AUDIO_PROMPT_SAMPLE_RATE  = 16000
 
 '''目标音频采样率'''
-AUDIO_TARGET_SAMPLE_RATE  = 22050
\ No newline at end of file
+AUDIO_TARGET_SAMPLE_RATE  = 22050
+
+'''模型缓存内存上限(MB)，超出后按最近最少使用顺序淘汰模型，0 表示不限制'''
+MODEL_CACHE_MAX_MEMORY_MB = 4096
+
+'''淘汰模型时转入冷存储(权重以 mmap 文件保留)而不是完全释放'''
+MODEL_CACHE_COLD_TIER     = False
+
+'''冷存储权重文件目录'''
+MODEL_CACHE_COLD_DIR      = os.path.join(COSYVOICE_MODEL_DIR, "cold_cache")
+
+'''变速实现："wsola" 为进程内 WSOLA，"ffmpeg" 为逐块调用 ffmpeg atempo'''
+SPEED_CHANGE_BACKEND      = "wsola"
+
+'''非流式多句合成时前端、LLM、flow、HiFT 分阶段流水线并行；各阶段线程共用全局随机数，开启后固定种子的结果不可复现，默认关闭'''
+SYNTHESIS_PIPELINE        = False
+
+'''多个合成请求并发时由同一调度线程连续批量解码 LLM（仅 CosyVoice 1 非 JIT 模型），0 表示关闭，否则为最大批量'''
+LLM_CONTINUOUS_BATCHING   = 0
+
+'''flow 质量/速度预设：ODE 求解器与步数(n_timesteps)，节点 quality 输入从中选择；估计器调用次数 euler/dpm_multistep 为步数，midpoint/heun 为两倍步数；可选 cfg_interval=(start, end) 只在该比例区间的步上做 CFG 引导，其余步估计器批量减半'''
+FLOW_QUALITY_PRESETS      = {
+    "高质量": {"solver": "midpoint", "n_timesteps": 10},
+    "标准": {"solver": "euler", "n_timesteps": 10},
+    "快速": {"solver": "dpm_multistep", "n_timesteps": 5},
+    "草稿": {"solver": "heun", "n_timesteps": 2},
+}
@@ -11,15 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
 from functools import partial
+import hashlib
 import json
+import threading
 import onnxruntime
 import torch
 import numpy as np
 import whisper
 from typing import Callable
 import torchaudio.compliance.kaldi as kaldi
-import torchaudio
 import os
 import re
 import inflect
@@ -31,9 +33,55 @@ except ImportError:
     from tn.chinese.normalizer import Normalizer as ZhNormalizer
     from tn.english.normalizer import Normalizer as EnNormalizer
     use_ttsfrd = False
+from cosyvoice.utils.resample import resample
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph
 
 
+class PromptCache:
+    """LRU cache of prompt features, keyed by the content of the prompt audio."""
+
+    def __init__(self, max_size: int = 16):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt_speech_16k, *args):
+        digest = hashlib.sha1(prompt_speech_16k.detach().cpu().float().contiguous().numpy().tobytes())
+        digest.update(repr((tuple(prompt_speech_16k.shape),) + args).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.cache.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits, self.misses = 0, 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+
 class CosyVoiceFrontEnd:
 
     def __init__(self,
@@ -43,7 +91,8 @@ class CosyVoiceFrontEnd:
                  speech_tokenizer_model: str,
                  spk2info: str = '',
                  instruct: bool = False,
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_size: int = 16):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -60,6 +109,7 @@ class CosyVoiceFrontEnd:
             self.spk2info = {}
         self.instruct = instruct
         self.allowed_special = allowed_special
+        self.prompt_cache = PromptCache(prompt_cache_size)
         self.inflect_parser = inflect.engine()
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
@@ -145,10 +195,14 @@ class CosyVoiceFrontEnd:
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
         return model_input
 
-    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate):
-        tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+    def _extract_prompt(self, prompt_text, prompt_speech_16k, resample_rate):
+        # prompt features only depend on the prompt, so they are shared by every segment of tts_text
+        key = self.prompt_cache.make_key(prompt_speech_16k, prompt_text, resample_rate)
+        prompt = self.prompt_cache.get(key)
+        if prompt is not None:
+            return prompt
         prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+        prompt_speech_resample = resample(prompt_speech_16k, 16000, resample_rate)
         speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
         speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
         if resample_rate == 24000:
@@ -157,12 +211,22 @@ class CosyVoiceFrontEnd:
             speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
             speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
         embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                  'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                  'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len,
+                  'embedding': embedding}
+        self.prompt_cache.put(key, prompt)
+        return prompt
+
+    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate):
+        tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+        prompt = self._extract_prompt(prompt_text, prompt_speech_16k, resample_rate)
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
-                       'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                       'llm_embedding': embedding, 'flow_embedding': embedding}
+                       'prompt_text': prompt['prompt_text'], 'prompt_text_len': prompt['prompt_text_len'],
+                       'llm_prompt_speech_token': prompt['speech_token'], 'llm_prompt_speech_token_len': prompt['speech_token_len'],
+                       'flow_prompt_speech_token': prompt['speech_token'], 'flow_prompt_speech_token_len': prompt['speech_token_len'],
+                       'prompt_speech_feat': prompt['speech_feat'], 'prompt_speech_feat_len': prompt['speech_feat_len'],
+                       'llm_embedding': prompt['embedding'], 'flow_embedding': prompt['embedding']}
         return model_input
 
     def frontend_cross_lingual(self, tts_text, prompt_speech_16k, resample_rate):
@@ -185,26 +249,17 @@ class CosyVoiceFrontEnd:
 
     def frontend_instruct2(self, tts_text, instruct_text, prompt_speech_16k, resample_rate):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        prompt_text_token, prompt_text_token_len = self._extract_text_token(instruct_text + '<|endofprompt|>')
-        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        if resample_rate == 24000:
-            # cosyvoice2, force speech_feat % speech_token = 2
-            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = self._extract_prompt(instruct_text + '<|endofprompt|>', prompt_speech_16k, resample_rate)
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
-                       'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                       'llm_embedding': embedding, 'flow_embedding': embedding}
+                       'prompt_text': prompt['prompt_text'], 'prompt_text_len': prompt['prompt_text_len'],
+                       'flow_prompt_speech_token': prompt['speech_token'], 'flow_prompt_speech_token_len': prompt['speech_token_len'],
+                       'prompt_speech_feat': prompt['speech_feat'], 'prompt_speech_feat_len': prompt['speech_feat_len'],
+                       'llm_embedding': prompt['embedding'], 'flow_embedding': prompt['embedding']}
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate):
         prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+        prompt_speech_resample = resample(prompt_speech_16k, 16000, resample_rate)
         prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
         embedding = self._extract_spk_embedding(prompt_speech_16k)
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
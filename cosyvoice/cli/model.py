@@ -12,13 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import torch
-import numpy as np
 import threading
 import time
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from contextlib import nullcontext
-import uuid
-from cosyvoice.utils.common import fade_in_out
+from collections import deque
+from cosyvoice.cli.scheduler import LLMScheduler
+from cosyvoice.cli.session import HopController, TTSSession
+from cosyvoice.utils.common import crossfade
+from cosyvoice.utils.pipeline import run_pipeline
+from cosyvoice.utils.file_utils import logging
 
 
 class CosyVoiceModel:
@@ -40,23 +44,19 @@ class CosyVoiceModel:
         self.flow.decoder.estimator.static_chunk_size = 0
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
-        # rtf and decoding related
-        self.stream_scale_factor = 1
-        assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
+        # rtf and decoding related, streaming hops are chosen per chunk from the measured rtf, see HopController
+        self.token_first_hop_len = self.flow.input_frame_rate // 2
+        self.stream_target_buffer = 0.5
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # first packet latency of recent streaming requests, in seconds
+        self.first_packet_latency = deque(maxlen=100)
+        # HopController decisions of recent streaming requests, one list of per-chunk dicts per request
+        self.hop_decisions = deque(maxlen=100)
+        # shared continuous batching llm decoder, see enable_llm_scheduler
+        self.llm_scheduler = None
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
@@ -88,21 +88,64 @@ class CosyVoiceModel:
         del self.flow.decoder.estimator
         self.flow.decoder.estimator = onnxruntime.InferenceSession(flow_decoder_estimator_model, sess_options=option, providers=providers)
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
+    def llm_generate(self, text, prompt_text, llm_prompt_speech_token, llm_embedding):
         if self.fp16 is True:
             llm_embedding = llm_embedding.half()
         with self.llm_context:
-            for i in self.llm.inference(text=text.to(self.device),
-                                        text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_text=prompt_text.to(self.device),
-                                        prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                        prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                        embedding=llm_embedding.to(self.device)):
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
-
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+            yield from self.llm.inference(text=text.to(self.device),
+                                          text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                          prompt_text=prompt_text.to(self.device),
+                                          prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                          prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                          prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                          embedding=llm_embedding.to(self.device))
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
+        # notify the consumer on every token, so it wakes as soon as a hop is available;
+        # an exception is handed to the consumer, session.wait_llm_end re-raises it
+        error = None
+        try:
+            for i in self.llm_generate(text, prompt_text, llm_prompt_speech_token, llm_embedding):
+                with session.cond:
+                    session.tokens.append(i)
+                    session.cond.notify()
+        except Exception as e:
+            error = e
+        finally:
+            with session.cond:
+                session.error = error
+                session.llm_end = True
+                session.cond.notify()
+
+    def enable_llm_scheduler(self, max_batch_size=16):
+        # decode concurrent tts() calls together in one LLMScheduler instead of one thread per call
+        if not hasattr(self.llm.llm, 'forward_chunk_batch'):
+            logging.warning('llm has no batched decoding (e.g. jit model), continuous batching is disabled')
+            return
+        self.llm_scheduler = LLMScheduler(self.llm, self.llm_context, max_batch_size=max_batch_size)
+
+    def shutdown(self):
+        # stop the decoding thread of the llm scheduler, it keeps the llm alive until then
+        if self.llm_scheduler is not None:
+            self.llm_scheduler.shutdown()
+
+    def llm_submit(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
+        # start decoding for session, tokens and llm_end are delivered through session either way
+        if self.llm_scheduler is None:
+            threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session)).start()
+            return
+        if self.fp16 is True:
+            llm_embedding = llm_embedding.half()
+        self.llm_scheduler.submit(session,
+                                  text=text.to(self.device),
+                                  text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                  prompt_text=prompt_text.to(self.device),
+                                  prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                  prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                  prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                  embedding=llm_embedding.to(self.device))
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, finalize=False, speed=1.0):
         tts_mel, flow_cache = self.flow.inference(token=token.to(self.device),
                                                   token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                   prompt_token=prompt_token.to(self.device),
@@ -110,153 +153,272 @@ class CosyVoiceModel:
                                                   prompt_feat=prompt_feat.to(self.device),
                                                   prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                   embedding=embedding.to(self.device),
-                                                  flow_cache=self.flow_cache_dict[uuid])
-        self.flow_cache_dict[uuid] = flow_cache
+                                                  flow_cache=session.flow_cache,
+                                                  **session.flow_options)
+        session.flow_cache = flow_cache
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = crossfade(tts_mel, session.mel_overlap, self.mel_overlap_len)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+            if session.hift_cache is not None:
+                tts_speech = crossfade(tts_speech, session.hift_cache['speech'], self.source_cache_len)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
                                           'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech = crossfade(tts_speech, session.hift_cache['speech'], self.source_cache_len)
         return tts_speech
 
+    def record_first_packet(self, start_time):
+        latency = time.time() - start_time
+        self.first_packet_latency.append(latency)
+        logging.info('first packet latency {:.3f}s'.format(latency))
+
+    def hop_controller(self, stream_options=None):
+        # stream_options overrides HopController arguments per request, e.g. {'target_buffer': 1.0, 'adaptive': False}
+        options = {'first_hop_len': self.token_first_hop_len,
+                   'min_hop_len': self.token_min_hop_len,
+                   'max_hop_len': self.token_max_hop_len,
+                   'target_buffer': self.stream_target_buffer}
+        options.update(stream_options or {})
+        return HopController(**options)
+
+    def record_hop_decisions(self, controller):
+        self.hop_decisions.append(controller.decisions)
+        logging.debug('stream hop decisions {}'.format(controller.decisions))
+
     def tts(self, text, flow_embedding, llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        p.start()
+            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, stream_options=None, flow_options=None, **kwargs):
+        # session holds the variables related to this inference thread
+        session = TTSSession(flow_options=flow_options)
+        self.llm_submit(text, prompt_text, llm_prompt_speech_token, llm_embedding, session)
         if stream is True:
-            token_hop_len = self.token_min_hop_len
+            start_time = time.time()
+            controller = self.hop_controller(stream_options)
+            token_hop_len = controller.next_hop()
             while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+                with session.cond:
+                    session.cond.wait_for(lambda: session.llm_end is True or len(session.tokens) >= token_hop_len + self.token_overlap_len)
+                    this_tts_speech_token = session.tokens.peek(token_hop_len + self.token_overlap_len)
+                if this_tts_speech_token.shape[1] == token_hop_len + self.token_overlap_len:
+                    chunk_start_time = time.time()
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                                                     session=session,
+                                                     finalize=False).cpu()
+                    controller.record(this_tts_speech_token.shape[1], time.time() - chunk_start_time, token_hop_len / self.flow.input_frame_rate)
+                    if start_time is not None:
+                        self.record_first_packet(start_time)
+                        start_time = None
+                    yield {'tts_speech': this_tts_speech}
+                    with session.cond:
+                        session.tokens.consume(token_hop_len)
+                    token_hop_len = controller.next_hop(self.token_overlap_len)
+                if session.llm_end is True and len(session.tokens) < token_hop_len + self.token_overlap_len:
                     break
-            p.join()
+            session.wait_llm_end()
+            self.record_hop_decisions(controller)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = session.tokens.peek()
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True)
+            if start_time is not None:
+                self.record_first_packet(start_time)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            session.wait_llm_end()
+            this_tts_speech_token = session.tokens.peek()
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True,
                                              speed=speed)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
-
-    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = source_speech_token.flatten().tolist(), True
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
+
+    def token2mel(self, token, prompt_token, prompt_feat, embedding, speed=1.0, flow_options=None):
+        # non-stream flow only, used as a pipeline stage by tts_pipeline
+        tts_mel, _ = self.flow.inference(token=token.to(self.device),
+                                         token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                         prompt_token=prompt_token.to(self.device),
+                                         prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                         prompt_feat=prompt_feat.to(self.device),
+                                         prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                         embedding=embedding.to(self.device),
+                                         flow_cache=torch.zeros(1, 80, 0, 2),
+                                         **(flow_options or {}))
+        if speed != 1.0:
+            tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
+        return tts_mel
+
+    def tts_pipeline(self, model_inputs, speed=1.0, queue_size=2, flow_options=None):
+        """Non-stream synthesis of a sequence of model inputs, e.g. the segments of one paragraph.
+
+        Frontend (iterating model_inputs), llm, flow and hift run as pipeline stages in separate threads
+        connected by bounded queues, so the llm decodes segment N + 1 while segment N is in flow and hift.
+        Yields one output dict per input, in order.
+        """
+        def llm_stage(model_input):
+            llm_inputs = (model_input['text'],
+                          model_input.get('prompt_text', torch.zeros(1, 0, dtype=torch.int32)),
+                          model_input.get('llm_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                          model_input.get('llm_embedding', torch.zeros(0, 192)))
+            if self.llm_scheduler is None:
+                return model_input, list(self.llm_generate(*llm_inputs))
+            # decode together with concurrent requests in the shared scheduler
+            session = TTSSession()
+            self.llm_submit(*llm_inputs, session)
+            session.wait_llm_end()
+            return model_input, session.tokens.peek()[0].tolist()
+
+        def flow_stage(item):
+            model_input, speech_token = item
+            return self.token2mel(token=torch.tensor(speech_token).unsqueeze(dim=0),
+                                  prompt_token=model_input.get('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                  prompt_feat=model_input.get('prompt_speech_feat', torch.zeros(1, 0, 80)),
+                                  embedding=model_input['flow_embedding'],
+                                  speed=speed,
+                                  flow_options=flow_options)
+
+        def hift_stage(tts_mel):
+            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, cache_source=torch.zeros(1, 1, 0))
+            return {'tts_speech': tts_speech.cpu()}
+
+        yield from run_pipeline(model_inputs, [llm_stage, flow_stage, hift_stage], queue_size=queue_size)
+
+    def llm_batch_job(self, model_inputs):
+        def pad(key, dtype=torch.int32):
+            tokens = [i.get(key, torch.zeros(1, 0, dtype=dtype)) for i in model_inputs]
+            return pad_sequence([t[0] for t in tokens], batch_first=True, padding_value=0).to(self.device), \
+                torch.tensor([t.shape[1] for t in tokens], dtype=torch.int32).to(self.device)
+        embeddings = [i.get('llm_embedding', torch.zeros(0, 192)) for i in model_inputs]
+        if len({e.shape[0] for e in embeddings}) != 1:
+            raise ValueError('can not batch requests with and without llm_embedding')
+        llm_embedding = torch.concat(embeddings, dim=0)
+        if self.fp16 is True:
+            llm_embedding = llm_embedding.half()
+        text, text_len = pad('text')
+        prompt_text, prompt_text_len = pad('prompt_text')
+        llm_prompt_speech_token, llm_prompt_speech_token_len = pad('llm_prompt_speech_token')
+        with self.llm_context:
+            return self.llm.inference_batch(text=text,
+                                            text_len=text_len,
+                                            prompt_text=prompt_text,
+                                            prompt_text_len=prompt_text_len,
+                                            prompt_speech_token=llm_prompt_speech_token,
+                                            prompt_speech_token_len=llm_prompt_speech_token_len,
+                                            embedding=llm_embedding.to(self.device))
+
+    def token2mel_batch(self, model_inputs, speech_tokens, speed=1.0, flow_options=None):
+        # non-stream flow of several utterances as one padded batch, returns one mel per input
+        def pad(tensors):
+            return pad_sequence([t[0] for t in tensors], batch_first=True, padding_value=0).to(self.device), \
+                torch.tensor([t.shape[1] for t in tensors], dtype=torch.int32).to(self.device)
+        token, token_len = pad([torch.tensor(speech_token, dtype=torch.int32).unsqueeze(dim=0) for speech_token in speech_tokens])
+        prompt_token, prompt_token_len = pad([i.get('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)) for i in model_inputs])
+        prompt_feat, prompt_feat_len = pad([i.get('prompt_speech_feat', torch.zeros(1, 0, 80)) for i in model_inputs])
+        embedding = torch.concat([i['flow_embedding'] for i in model_inputs], dim=0)
+        tts_mels = self.flow.inference_batch(token=token,
+                                             token_len=token_len,
+                                             prompt_token=prompt_token,
+                                             prompt_token_len=prompt_token_len,
+                                             prompt_feat=prompt_feat,
+                                             prompt_feat_len=prompt_feat_len,
+                                             embedding=embedding.to(self.device),
+                                             **(flow_options or {}))
+        if speed != 1.0:
+            tts_mels = [F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear') for tts_mel in tts_mels]
+        return tts_mels
+
+    def tts_batch(self, model_inputs, speed=1.0, flow_options=None):
+        """Non-stream synthesis of several model inputs, the llm decodes them as one batch and flow solves them as one batch.
+
+        Falls back to one tts() call per input when the llm has no batched decoding (e.g. jit model).
+        Yields one output dict per input, in order.
+        """
+        if not hasattr(self.llm.llm, 'forward_chunk_batch'):
+            for model_input in model_inputs:
+                yield from self.tts(**model_input, stream=False, speed=speed, flow_options=flow_options)
+            return
+        speech_tokens = self.llm_batch_job(model_inputs)
+        for tts_mel in self.token2mel_batch(model_inputs, speech_tokens, speed=speed, flow_options=flow_options):
+            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, cache_source=torch.zeros(1, 1, 0))
+            yield {'tts_speech': tts_speech.cpu()}
+
+    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0,
+           stream_options=None, flow_options=None, **kwargs):
+        # session holds the variables related to this inference thread, all source tokens are available upfront
+        session = TTSSession(capacity=max(source_speech_token.numel(), 1), flow_options=flow_options)
+        session.tokens.extend(source_speech_token)
+        session.llm_end = True
         if stream is True:
-            token_hop_len = self.token_min_hop_len
+            controller = self.hop_controller(stream_options)
+            token_hop_len = controller.next_hop()
             while True:
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+                if len(session.tokens) >= token_hop_len + self.token_overlap_len:
+                    this_tts_speech_token = session.tokens.peek(token_hop_len + self.token_overlap_len)
+                    chunk_start_time = time.time()
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                                                     session=session,
+                                                     finalize=False).cpu()
+                    controller.record(this_tts_speech_token.shape[1], time.time() - chunk_start_time, token_hop_len / self.flow.input_frame_rate)
+                    yield {'tts_speech': this_tts_speech}
+                    session.tokens.consume(token_hop_len)
+                    token_hop_len = controller.next_hop(self.token_overlap_len)
+                if session.llm_end is True and len(session.tokens) < token_hop_len + self.token_overlap_len:
                     break
+            self.record_hop_decisions(controller)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = session.tokens.peek()
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = session.tokens.peek()
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True,
                                              speed=speed)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
 
 
 class CosyVoice2Model:
@@ -276,16 +438,15 @@ class CosyVoice2Model:
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
-        # rtf and decoding related
-        self.stream_scale_factor = 1
+        # rtf and decoding related, streaming hops are chosen per chunk from the measured rtf, see HopController;
+        # hops stay multiples of token_hop_len so they line up with the static chunks of the flow encoder
+        self.token_max_hop_len = 4 * self.token_hop_len
+        self.stream_target_buffer = 0.5
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # first packet latency of recent streaming requests, in seconds
+        self.first_packet_latency = deque(maxlen=100)
+        # HopController decisions of recent streaming requests, one list of per-chunk dicts per request
+        self.hop_decisions = deque(maxlen=100)
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
@@ -319,19 +480,34 @@ class CosyVoice2Model:
         self.flow.decoder.estimator = self.flow.decoder.estimator_engine.create_execution_context()
         self.flow.decoder.fp16 = True
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
+    def llm_generate(self, text, prompt_text, llm_prompt_speech_token, llm_embedding):
         with self.llm_context:
-            for i in self.llm.inference(text=text.to(self.device),
-                                        text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_text=prompt_text.to(self.device),
-                                        prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                        prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                        embedding=llm_embedding.to(self.device)):
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
-
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, token_offset, finalize=False, speed=1.0):
+            yield from self.llm.inference(text=text.to(self.device),
+                                          text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                          prompt_text=prompt_text.to(self.device),
+                                          prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                          prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                          prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                          embedding=llm_embedding.to(self.device))
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
+        # notify the consumer on every token, so it wakes as soon as a hop is available;
+        # an exception is handed to the consumer, session.wait_llm_end re-raises it
+        error = None
+        try:
+            for i in self.llm_generate(text, prompt_text, llm_prompt_speech_token, llm_embedding):
+                with session.cond:
+                    session.tokens.append(i)
+                    session.cond.notify()
+        except Exception as e:
+            error = e
+        finally:
+            with session.cond:
+                session.error = error
+                session.llm_end = True
+                session.cond.notify()
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, token_offset, finalize=False, speed=1.0):
         tts_mel, _ = self.flow.inference(token=token.to(self.device),
                                          token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                          prompt_token=prompt_token.to(self.device),
@@ -339,85 +515,158 @@ class CosyVoice2Model:
                                          prompt_feat=prompt_feat.to(self.device),
                                          prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                          embedding=embedding.to(self.device),
-                                         finalize=finalize)
+                                         finalize=finalize,
+                                         **session.flow_options)
         tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+            if session.hift_cache is not None:
+                tts_speech = crossfade(tts_speech, session.hift_cache['speech'], self.source_cache_len)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
                                           'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech = crossfade(tts_speech, session.hift_cache['speech'], self.source_cache_len)
         return tts_speech
 
+    def token2mel(self, token, prompt_token, prompt_feat, embedding, speed=1.0, flow_options=None):
+        # non-stream flow only, used as a pipeline stage by tts_pipeline
+        tts_mel, _ = self.flow.inference(token=token.to(self.device),
+                                         token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                         prompt_token=prompt_token.to(self.device),
+                                         prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                         prompt_feat=prompt_feat.to(self.device),
+                                         prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                         embedding=embedding.to(self.device),
+                                         finalize=True,
+                                         **(flow_options or {}))
+        if speed != 1.0:
+            tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
+        return tts_mel
+
+    def tts_pipeline(self, model_inputs, speed=1.0, queue_size=2, flow_options=None):
+        """Non-stream synthesis of a sequence of model inputs, e.g. the segments of one paragraph.
+
+        Frontend (iterating model_inputs), llm, flow and hift run as pipeline stages in separate threads
+        connected by bounded queues, so the llm decodes segment N + 1 while segment N is in flow and hift.
+        Yields one output dict per input, in order.
+        """
+        def llm_stage(model_input):
+            speech_token = list(self.llm_generate(model_input['text'],
+                                                  model_input.get('prompt_text', torch.zeros(1, 0, dtype=torch.int32)),
+                                                  model_input.get('llm_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                                  model_input.get('llm_embedding', torch.zeros(0, 192))))
+            return model_input, speech_token
+
+        def flow_stage(item):
+            model_input, speech_token = item
+            return self.token2mel(token=torch.tensor(speech_token).unsqueeze(dim=0),
+                                  prompt_token=model_input.get('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                  prompt_feat=model_input.get('prompt_speech_feat', torch.zeros(1, 0, 80)),
+                                  embedding=model_input['flow_embedding'],
+                                  speed=speed,
+                                  flow_options=flow_options)
+
+        def hift_stage(tts_mel):
+            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, cache_source=torch.zeros(1, 1, 0))
+            return {'tts_speech': tts_speech.cpu()}
+
+        yield from run_pipeline(model_inputs, [llm_stage, flow_stage, hift_stage], queue_size=queue_size)
+
+    def record_first_packet(self, start_time):
+        latency = time.time() - start_time
+        self.first_packet_latency.append(latency)
+        logging.info('first packet latency {:.3f}s'.format(latency))
+
+    def hop_controller(self, stream_options=None):
+        # stream_options overrides HopController arguments per request, e.g. {'target_buffer': 1.0, 'adaptive': False}
+        options = {'first_hop_len': self.token_hop_len,
+                   'min_hop_len': self.token_hop_len,
+                   'max_hop_len': self.token_max_hop_len,
+                   'target_buffer': self.stream_target_buffer,
+                   'granularity': self.token_hop_len}
+        options.update(stream_options or {})
+        return HopController(**options)
+
+    def record_hop_decisions(self, controller):
+        self.hop_decisions.append(controller.decisions)
+        logging.debug('stream hop decisions {}'.format(controller.decisions))
+
     def tts(self, text, flow_embedding, llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, stream_options=None, flow_options=None, **kwargs):
+        # session holds the variables related to this inference thread
+        session = TTSSession(flow_options=flow_options)
+        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session))
         p.start()
         if stream is True:
+            start_time = time.time()
+            controller = self.hop_controller(stream_options)
+            token_hop_len = controller.next_hop()
             token_offset = 0
             while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= self.token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + self.token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+                # the flow of CosyVoice2 always restarts from the first token, so tokens are never consumed
+                with session.cond:
+                    session.cond.wait_for(lambda: session.llm_end is True or
+                                          len(session.tokens) - token_offset >= token_hop_len + self.flow.pre_lookahead_len)
+                    this_tts_speech_token = session.tokens.peek(token_offset + token_hop_len + self.flow.pre_lookahead_len)
+                if this_tts_speech_token.shape[1] - token_offset == token_hop_len + self.flow.pre_lookahead_len:
+                    chunk_start_time = time.time()
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     uuid=this_uuid,
+                                                     session=session,
                                                      token_offset=token_offset,
-                                                     finalize=False)
-                    token_offset += self.token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < self.token_hop_len + self.flow.pre_lookahead_len:
+                                                     finalize=False).cpu()
+                    controller.record(this_tts_speech_token.shape[1], time.time() - chunk_start_time, token_hop_len / self.flow.input_frame_rate)
+                    token_offset += token_hop_len
+                    if start_time is not None:
+                        self.record_first_packet(start_time)
+                        start_time = None
+                    yield {'tts_speech': this_tts_speech}
+                    token_hop_len = controller.next_hop(token_offset + self.flow.pre_lookahead_len)
+                if session.llm_end is True and len(session.tokens) - token_offset < token_hop_len + self.flow.pre_lookahead_len:
                     break
-            p.join()
+            session.wait_llm_end()
+            self.record_hop_decisions(controller)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = session.tokens.peek()
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              token_offset=token_offset,
                                              finalize=True)
+            if start_time is not None:
+                self.record_first_packet(start_time)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            session.wait_llm_end()
+            this_tts_speech_token = session.tokens.peek()
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              token_offset=0,
                                              finalize=True,
                                              speed=speed)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
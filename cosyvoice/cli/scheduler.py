@@ -0,0 +1,185 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import inspect
+import threading
+from collections import deque
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class _Sequence:
+    __slots__ = ('session', 'out_tokens', 'step', 'min_len', 'max_len')
+
+    def __init__(self, session, min_len, max_len):
+        self.session = session
+        self.out_tokens = []
+        self.step = 0
+        self.min_len = min_len
+        self.max_len = max_len
+
+
+def _left_pad(att_cache, key_mask, length):
+    pad = length - key_mask.size(1)
+    if pad == 0:
+        return att_cache, key_mask
+    att_cache = torch.nn.functional.pad(att_cache, (0, 0, pad, 0))
+    key_mask = torch.nn.functional.pad(key_mask, (pad, 0), value=False)
+    return att_cache, key_mask
+
+
+class LLMScheduler:
+    """Continuous batching of TransformerLM decoding for concurrent tts() calls.
+
+    A single thread owns the llm. Between two decoding steps it admits submitted sessions (prefill
+    of their prompt, up to max_batch_size in flight) and retires finished ones; every step then feeds
+    the last token of all active sessions through one batched forward_chunk_batch call. Rows of
+    different lengths share one left padded attention cache, so results match TransformerLM.inference
+    when the llm uses relative positional encoding. Tokens and errors are delivered through each
+    TTSSession exactly as llm_job does. Sampling options left as None take the defaults of
+    llm.inference, like the unbatched llm_job.
+    """
+
+    def __init__(self, llm, llm_context, max_batch_size: int = 16, sampling: int = None,
+                 max_token_text_ratio: float = None, min_token_text_ratio: float = None):
+        self.llm = llm
+        self.llm_context = llm_context
+        self.max_batch_size = max_batch_size
+        defaults = inspect.signature(llm.inference).parameters
+        self.sampling = defaults['sampling'].default if sampling is None else sampling
+        self.max_token_text_ratio = defaults['max_token_text_ratio'].default if max_token_text_ratio is None else max_token_text_ratio
+        self.min_token_text_ratio = defaults['min_token_text_ratio'].default if min_token_text_ratio is None else min_token_text_ratio
+        self.pending = deque()
+        self.cond = threading.Condition()
+        # serializes starting and stopping the decoding thread
+        self.lifecycle = threading.Lock()
+        self.thread = None
+        self.stop = None
+
+    def submit(self, session, text, text_len, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len, embedding):
+        """Queue one utterance for decoding, inputs are batch size 1 tensors on the llm device."""
+        with self.lifecycle, self.cond:
+            self.pending.append((session, (text, text_len, prompt_text, prompt_text_len,
+                                           prompt_speech_token, prompt_speech_token_len, embedding)))
+            if self.thread is None:
+                self.stop = threading.Event()
+                self.thread = threading.Thread(target=self.run, args=(self.stop,), daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def shutdown(self):
+        """Stop the decoding thread and wait for it, sessions still queued or decoding end with an error.
+
+        Afterwards no thread references the llm, so it can be freed; a later submit starts a new thread.
+        """
+        with self.lifecycle:
+            with self.cond:
+                thread, self.thread = self.thread, None
+                if thread is None:
+                    return
+                self.stop.set()
+                self.cond.notify()
+            thread.join()
+
+    def run(self, stop):
+        sequences, att_cache, key_mask = [], None, None
+        with self.llm_context:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: stop.is_set() or len(self.pending) != 0 or len(sequences) != 0)
+                    if stop.is_set():
+                        sequences += [_Sequence(session, 0, 0) for session, _ in self.pending]
+                        self.pending.clear()
+                        break
+                    admitted = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch_size - len(sequences)))]
+                for session, inputs in admitted:
+                    try:
+                        sequence, this_att_cache = self.prefill(session, inputs)
+                    except Exception as e:
+                        logging.exception('llm prefill failed')
+                        self.finish(_Sequence(session, 0, 0), e)
+                        continue
+                    if sequence is None:
+                        continue
+                    this_key_mask = torch.ones(1, this_att_cache.size(3), dtype=torch.bool, device=this_att_cache.device)
+                    if len(sequences) == 0:
+                        att_cache, key_mask = this_att_cache, this_key_mask
+                    else:
+                        length = max(key_mask.size(1), this_key_mask.size(1))
+                        att_cache, key_mask = _left_pad(att_cache, key_mask, length)
+                        this_att_cache, this_key_mask = _left_pad(this_att_cache, this_key_mask, length)
+                        att_cache = torch.concat([att_cache, this_att_cache], dim=1)
+                        key_mask = torch.concat([key_mask, this_key_mask], dim=0)
+                    sequences.append(sequence)
+                if len(sequences) == 0:
+                    continue
+                try:
+                    sequences, att_cache, key_mask = self.step(sequences, att_cache, key_mask)
+                except Exception as e:
+                    logging.exception('llm decoding step failed')
+                    for sequence in sequences:
+                        self.finish(sequence, e)
+                    sequences, att_cache, key_mask = [], None, None
+        for sequence in sequences:
+            self.finish(sequence, RuntimeError('llm scheduler is shut down'))
+
+    @torch.inference_mode()
+    def prefill(self, session, inputs):
+        text = inputs[0]
+        sequence = _Sequence(session, int(text.shape[1] * self.min_token_text_ratio), int(text.shape[1] * self.max_token_text_ratio))
+        if sequence.max_len == 0:
+            self.finish(sequence)
+            return None, None
+        logp, att_cache = self.llm.prefill(*inputs)
+        if not self.emit(sequence, logp):
+            return None, None
+        return sequence, att_cache
+
+    @torch.inference_mode()
+    def step(self, sequences, att_cache, key_mask):
+        logp, att_cache, key_mask = self.llm.decode_step([s.out_tokens[-1] for s in sequences], att_cache, key_mask)
+        keep = [row for row, sequence in enumerate(sequences) if self.emit(sequence, logp[row])]
+        if len(keep) == 0:
+            return [], None, None
+        if len(keep) != len(sequences):
+            rows = torch.tensor(keep, device=key_mask.device)
+            att_cache, key_mask = att_cache[:, rows], key_mask[rows]
+            sequences = [sequences[row] for row in keep]
+            # drop the leading columns that only held padding of the retired rows
+            start = int(key_mask.any(dim=0).nonzero()[0])
+            att_cache, key_mask = att_cache[:, :, :, start:], key_mask[:, start:]
+        return sequences, att_cache, key_mask
+
+    def emit(self, sequence, logp):
+        """Sample the next token of sequence, returns False once it is finished."""
+        top_ids = self.llm.sampling_ids(logp, sequence.out_tokens, self.sampling,
+                                        ignore_eos=True if sequence.step < sequence.min_len else False).item()
+        if top_ids == self.llm.speech_token_size:
+            self.finish(sequence)
+            return False
+        sequence.out_tokens.append(top_ids)
+        sequence.step += 1
+        with sequence.session.cond:
+            sequence.session.tokens.append(top_ids)
+            sequence.session.cond.notify()
+        if sequence.step >= sequence.max_len:
+            self.finish(sequence)
+            return False
+        return True
+
+    def finish(self, sequence, error=None):
+        """End decoding of sequence, error is re-raised by the consumer in session.wait_llm_end."""
+        with sequence.session.cond:
+            sequence.session.error = error
+            sequence.session.llm_end = True
+            sequence.session.cond.notify()
@@ -0,0 +1,155 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+import torch
+
+
+class TokenRingBuffer:
+    """Preallocated int32 ring buffer of speech tokens.
+
+    Reading a window returns a view unless it wraps around, consuming only moves the head,
+    so per-hop work is O(hop). The buffer doubles when the producer gets a full ring ahead.
+    """
+    __slots__ = ('buffer', 'head', 'tail')
+
+    def __init__(self, capacity: int = 1024):
+        self.buffer = torch.zeros(capacity, dtype=torch.int32)
+        # absolute positions, the ring index is position % capacity
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, token: int):
+        capacity = self.buffer.size(0)
+        if self.tail - self.head == capacity:
+            self._grow()
+            capacity = self.buffer.size(0)
+        self.buffer[self.tail % capacity] = token
+        self.tail += 1
+
+    def extend(self, tokens: torch.Tensor):
+        for token in tokens.flatten().tolist():
+            self.append(token)
+
+    def peek(self, n: int = -1) -> torch.Tensor:
+        """Return the first n unread tokens (all when n < 0) with shape (1, n), without consuming them."""
+        n = len(self) if n < 0 else min(n, len(self))
+        capacity = self.buffer.size(0)
+        start = self.head % capacity
+        end = start + n
+        if end <= capacity:
+            return self.buffer[start:end].unsqueeze(dim=0)
+        return torch.concat([self.buffer[start:], self.buffer[:end - capacity]]).unsqueeze(dim=0)
+
+    def consume(self, n: int):
+        self.head += min(n, len(self))
+
+    def _grow(self):
+        size = len(self)
+        buffer = torch.zeros(2 * self.buffer.size(0), dtype=torch.int32)
+        buffer[:size] = self.peek()[0]
+        self.buffer, self.head, self.tail = buffer, 0, size
+
+
+class TTSSession:
+    """State of one tts()/vc() call: speech tokens, llm status, flow/hift caches and the session's own lock.
+
+    cond is bound to lock: the llm thread appends tokens and notifies under it, the consumer waits on it.
+    If decoding fails, the llm thread stores the exception in error before setting llm_end, and
+    wait_llm_end re-raises it in the consumer.
+    flow_options are extra flow.inference arguments of this call, e.g. {'n_timesteps': 5, 'solver': 'heun'}.
+    """
+    __slots__ = ('tokens', 'llm_end', 'error', 'lock', 'cond', 'mel_overlap', 'flow_cache', 'hift_cache', 'flow_options')
+
+    def __init__(self, capacity: int = 1024, flow_options: dict = None):
+        self.tokens = TokenRingBuffer(capacity)
+        self.llm_end = False
+        self.error = None
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.mel_overlap = torch.zeros(1, 80, 0)
+        self.flow_cache = torch.zeros(1, 80, 0, 2)
+        self.hift_cache = None
+        self.flow_options = flow_options or {}
+
+    def wait_llm_end(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.llm_end is True)
+        if self.error is not None:
+            raise self.error
+
+
+class HopController:
+    """Chooses the token hop of each streaming chunk from the measured cost of token2wav.
+
+    The playback buffer is the audio yielded so far minus the wall time since the first chunk was
+    yielded. The first chunk uses first_hop_len for low latency; after that the hop is the largest one
+    whose token2wav is expected to finish while target_buffer seconds of audio are still queued,
+    clamped to [min_hop_len, max_hop_len] and rounded down to a multiple of granularity.
+    With adaptive=False every chunk after the first uses min_hop_len.
+    """
+    __slots__ = ('first_hop_len', 'min_hop_len', 'max_hop_len', 'target_buffer', 'adaptive', 'granularity',
+                 'smoothing', 'cost_per_token', 'speech_len', 'start_time', 'decisions')
+
+    def __init__(self, first_hop_len: int, min_hop_len: int, max_hop_len: int, target_buffer: float = 0.5,
+                 adaptive: bool = True, granularity: int = 1, smoothing: float = 0.5):
+        assert 0 < first_hop_len and 0 < min_hop_len <= max_hop_len, 'invalid hop lengths'
+        self.first_hop_len = first_hop_len
+        self.min_hop_len = min_hop_len
+        self.max_hop_len = max_hop_len
+        self.target_buffer = target_buffer
+        self.adaptive = adaptive
+        self.granularity = granularity
+        self.smoothing = smoothing
+        # seconds of token2wav per input token, exponential moving average
+        self.cost_per_token = None
+        self.speech_len = 0.0
+        self.start_time = None
+        # one dict per chunk: hop_len, token2wav rtf, buffered seconds at decision time
+        self.decisions = []
+
+    def buffered(self) -> float:
+        if self.start_time is None:
+            return 0.0
+        return self.speech_len - (time.time() - self.start_time)
+
+    def record(self, token_len: int, compute_time: float, speech_len: float):
+        """Record one token2wav call over token_len input tokens that produced speech_len seconds of audio."""
+        cost = compute_time / max(token_len, 1)
+        if self.cost_per_token is None:
+            self.cost_per_token = cost
+        else:
+            self.cost_per_token = self.smoothing * self.cost_per_token + (1 - self.smoothing) * cost
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.speech_len += speech_len
+        if self.decisions:
+            self.decisions[-1]['rtf'] = compute_time / speech_len if speech_len > 0 else float('inf')
+
+    def next_hop(self, context_len: int = 0) -> int:
+        """Hop for the next chunk, context_len is the number of extra tokens token2wav will process with it."""
+        buffered = self.buffered()
+        if self.cost_per_token is None:
+            hop_len = self.first_hop_len
+        elif self.adaptive is False or buffered <= self.target_buffer:
+            hop_len = self.min_hop_len
+        else:
+            hop_len = int((buffered - self.target_buffer) / self.cost_per_token) - context_len
+            hop_len = max(self.min_hop_len, min(self.max_hop_len, hop_len))
+            hop_len = max(self.min_hop_len, hop_len // self.granularity * self.granularity)
+        self.decisions.append({'hop_len': hop_len, 'buffered': buffered})
+        return hop_len
@@ -55,6 +55,33 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
 
+def masked_block1d(block: Block1D, x: torch.Tensor, mask: torch.Tensor):
+    """Block1D forward whose GroupNorm statistics are taken over the frames under mask only.
+
+    Padded frames then do not change the valid frames, ConditionalDecoder uses it for padded
+    batches (see MaskedDiffWithXvec.inference_batch).
+    """
+    conv, norm, act = block.block
+    x = conv(x * mask)
+    b, c, t = x.shape
+    x = x.view(b, norm.num_groups, -1, t)
+    group_mask = mask.unsqueeze(dim=1)
+    count = (group_mask.sum(dim=(2, 3), keepdim=True) * x.shape[2]).clamp(min=1)
+    mean = (x * group_mask).sum(dim=(2, 3), keepdim=True) / count
+    var = ((x - mean) * group_mask).pow(2).sum(dim=(2, 3), keepdim=True) / count
+    x = ((x - mean) * torch.rsqrt(var + norm.eps)).view(b, c, t)
+    output = act(x * norm.weight.unsqueeze(dim=-1) + norm.bias.unsqueeze(dim=-1))
+    return output * mask
+
+
+def masked_resnet_block1d(resnet: ResnetBlock1D, x: torch.Tensor, mask: torch.Tensor, time_emb: torch.Tensor):
+    """ResnetBlock1D forward with masked_block1d in place of its two blocks."""
+    h = masked_block1d(resnet.block1, x, mask)
+    h += resnet.mlp(time_emb).unsqueeze(-1)
+    h = masked_block1d(resnet.block2, h, mask)
+    return h + resnet.res_conv(x * mask)
+
+
 class CausalConv1d(torch.nn.Conv1d):
     def __init__(
         self,
@@ -114,6 +141,8 @@ class ConditionalDecoder(nn.Module):
             time_embed_dim=time_embed_dim,
             act_fn="silu",
         )
+        # time_mlp outputs of fixed t schedules, filled and keyed by ConditionalCFM.time_embedding_table
+        self.time_embedding_cache = {}
         self.down_blocks = nn.ModuleList([])
         self.mid_blocks = nn.ModuleList([])
         self.up_blocks = nn.ModuleList([])
@@ -214,7 +243,32 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def embed_time(self, t):
+        """time_mlp(time_embeddings(t)), shape (batch_size,) -> (batch_size, time_embed_dim)."""
+        t = self.time_embeddings(t).to(t.dtype)
+        return self.time_mlp(t)
+
+    def attention_masks(self, mask, dtype):
+        """Attention bias of every resolution level, level i has time // 2**i frames.
+
+        They only depend on mask and static_chunk_size, so ConditionalCFM builds them once per ODE
+        solve and passes them to every estimator call instead of rebuilding them in every block.
+
+        Args:
+            mask (torch.Tensor): shape (batch_size, 1, time)
+            dtype (torch.dtype): dtype of the hidden states
+
+        Returns:
+            list: one bias per level, shape (batch_size, 1 or time, time)
+        """
+        attn_masks = []
+        for _ in range(len(self.down_blocks)):
+            attn_mask = add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1)
+            attn_masks.append(mask_to_bias(attn_mask == 1, dtype))
+            mask = mask[:, :, ::2]
+        return attn_masks
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, attn_masks=None, t_emb=None, masked_norm=False):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -223,6 +277,11 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            attn_masks (list, optional): output of attention_masks(mask, x.dtype). Built here when None.
+            t_emb (torch.Tensor, optional): embed_time(t), shape (time_embed_dim,) or (batch_size, time_embed_dim).
+                Computed here when None.
+            masked_norm (bool, optional): take the GroupNorm statistics of the non-causal blocks over the frames
+                under mask only (masked_block1d), for right padded batches. Defaults to False, nn.GroupNorm.
 
         Raises:
             ValueError: _description_
@@ -232,8 +291,14 @@ class ConditionalDecoder(nn.Module):
             _type_: _description_
         """
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        if attn_masks is None:
+            attn_masks = self.attention_masks(mask, x.dtype)
+
+        if t_emb is None:
+            t = self.embed_time(t)
+        else:
+            t = t_emb.expand(x.size(0), -1)
+        masked_norm = masked_norm and not self.causal
 
         x = pack([x, mu], "b * t")[0]
 
@@ -245,13 +310,11 @@ class ConditionalDecoder(nn.Module):
 
         hiddens = []
         masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
+        for level, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
             mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
+            x = masked_resnet_block1d(resnet, x, mask_down, t) if masked_norm else resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = attn_masks[level]
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -266,11 +329,9 @@ class ConditionalDecoder(nn.Module):
         mask_mid = masks[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
+            x = masked_resnet_block1d(resnet, x, mask_mid, t) if masked_norm else resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = attn_masks[-1]
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -279,15 +340,13 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
+        for level, (resnet, transformer_blocks, upsample) in enumerate(self.up_blocks):
             mask_up = masks.pop()
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
+            x = masked_resnet_block1d(resnet, x, mask_up, t) if masked_norm else resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = attn_masks[-1 - level]
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -296,6 +355,6 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
+        x = masked_block1d(self.final_block, x, mask_up) if masked_norm else self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
         return output * mask
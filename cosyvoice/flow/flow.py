@@ -17,6 +17,7 @@ from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -110,7 +111,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_interval=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -139,14 +143,90 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            flow_cache=flow_cache
+            flow_cache=flow_cache,
+            solver=solver,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat, flow_cache
 
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        n_timesteps=10,
+                        solver=None,
+                        cfg_interval=None,
+                        seeds=None):
+        """Non-stream inference of several utterances with one ODE solve.
+
+        token, prompt_token and prompt_feat are right padded along time, their lengths give the valid part
+        of every item. Prompt and speech tokens are joined per item, the length regulator runs per item and
+        the decoder solves the padded batch under its mask. When the items differ in length the decoder takes
+        its GroupNorm statistics over the valid frames only (masked_norm), so padding does not change an item,
+        equal lengths keep nn.GroupNorm. onnx/trt estimators always normalise over the whole padded batch.
+        By default the initial noise is drawn once for the whole padded batch, so an item's mel depends on
+        its position in the batch. With seeds, item i draws its own noise from seeds[i], the same noise as
+        inference() after torch.manual_seed(seeds[i]), and gets the mel of that single inference.
+        Returns one mel per item, (1, output_size, mel_len2).
+        """
+        batch_size = token.shape[0]
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text of every item
+        token_len1, token_len2 = prompt_token_len.tolist(), token_len.tolist()
+        token = pad_sequence([torch.concat([prompt_token[i, :token_len1[i]], token[i, :token_len2[i]]]) for i in range(batch_size)],
+                             batch_first=True, padding_value=0)
+        token_len = prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        h, h_lengths = self.encoder(token, token_len)
+        h = self.encoder_proj(h)
+        mel_len1 = prompt_feat_len.tolist()
+        mel_len2 = [int(i / self.input_frame_rate * 22050 / 256) for i in token_len2]
+        h = pad_sequence([self.length_regulator.inference(h[i:i + 1, :token_len1[i]], h[i:i + 1, token_len1[i]:token_len1[i] + token_len2[i]],
+                                                          mel_len1[i], mel_len2[i], self.input_frame_rate)[0][0] for i in range(batch_size)],
+                         batch_first=True, padding_value=0)
+
+        # get conditions
+        conds = torch.zeros([batch_size, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        for i in range(batch_size):
+            conds[i, :mel_len1[i]] = prompt_feat[i, :mel_len1[i]]
+        conds = conds.transpose(1, 2)
+
+        mel_len = [i + j for i, j in zip(mel_len1, mel_len2)]
+        mask = (~make_pad_mask(torch.tensor(mel_len), h.shape[1])).to(h)
+        noise = None
+        if seeds is not None:
+            noise = torch.zeros([batch_size, self.output_size, h.shape[1]], device=h.device, dtype=h.dtype)
+            for i in range(batch_size):
+                generator = torch.Generator(device=h.device).manual_seed(seeds[i])
+                noise[i, :, :mel_len[i]] = torch.randn([self.output_size, mel_len[i]], generator=generator, device=h.device, dtype=h.dtype)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_interval=cfg_interval,
+            masked_norm=min(mel_len) != max(mel_len),
+            noise=noise
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len1[i] + mel_len2[i]] for i in range(batch_size)]
+
 
 class CausalMaskedDiffWithXvec(torch.nn.Module):
     def __init__(self,
@@ -195,7 +275,10 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_interval=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -224,7 +307,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
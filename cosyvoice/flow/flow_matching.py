@@ -18,6 +18,14 @@ from matcha.models.components.flow_matching import BASECFM
 
 
 class ConditionalCFM(BASECFM):
+    # ODE solvers selectable by name in forward(), every one calls velocity() to query the estimator
+    solvers = {
+        'euler': 'solve_euler',
+        'midpoint': 'solve_midpoint',
+        'heun': 'solve_heun',
+        'dpm_multistep': 'solve_dpm_multistep',
+    }
+
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
             n_feats=in_channels,
@@ -28,12 +36,17 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # default solver, can be overridden per forward() call
+        self.solver = getattr(cfm_params, 'solver', 'euler')
+        # fraction (start, end) of the solver steps that apply classifier-free guidance, see cfg_schedule()
+        self.cfg_interval = (0.0, 1.0)
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2),
+                solver=None, cfg_interval=None, masked_norm=False, noise=None):
         """Forward diffusion
 
         Args:
@@ -46,13 +59,18 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): name in ConditionalCFM.solvers. Defaults to cfm_params.solver.
+            cfg_interval (tuple, optional): guided fraction of the steps, see cfg_schedule(). Defaults to self.cfg_interval.
+            masked_norm (bool, optional): decoder normalisation over the frames under mask only, for right padded
+                batches (torch estimator only). Defaults to False.
+            noise (torch.Tensor, optional): initial noise, shape as mu. Defaults to torch.randn_like(mu).
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = torch.randn_like(mu) * temperature
+        z = (torch.randn_like(mu) if noise is None else noise) * temperature
         cache_size = flow_cache.shape[2]
         # fix prompt and overlap part mu and z
         if cache_size != 0:
@@ -65,9 +83,18 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_interval=cfg_interval,
+                          masked_norm=masked_norm), flow_cache
+
+    def solve(self, x, t_span, mu, mask, spks, cond, solver=None, cfg_interval=None, masked_norm=False):
+        solver = self.solver if solver is None else solver
+        if solver not in self.solvers:
+            raise ValueError('unknown flow matching solver {}, available solvers are {}'.format(solver, list(self.solvers)))
+        guided = self.cfg_schedule(len(t_span) - 1, cfg_interval)
+        return getattr(self, self.solvers[solver])(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, guided=guided,
+                                                   masked_norm=masked_norm)
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, guided=None, masked_norm=False):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -81,6 +108,8 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            guided (list, optional): per step flag of classifier-free guidance. Defaults to cfg_schedule().
+            masked_norm (bool, optional): passed to the estimator, see forward().
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
@@ -89,36 +118,11 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
-        if self.inference_cfg_rate > 0:
-            # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-            x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-            mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-            mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-            t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-            spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-            cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        else:
-            x_in, mask_in, mu_in, t_in, spks_in, cond_in = x, mask, mu, t, spks, cond
+        cfg_inputs, attn_masks = self.cfg_inputs(x), self.attention_masks(x, mask)
+        t_embs = self.time_embedding_table(t_span)
+        guided = self.cfg_schedule(len(t_span) - 1) if guided is None else guided
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            if self.inference_cfg_rate > 0:
-                x_in[:] = x
-                mask_in[:] = mask
-                mu_in[0] = mu
-                t_in[:] = t.unsqueeze(0)
-                spks_in[0] = spks
-                cond_in[0] = cond
-            else:
-                x_in, mask_in, mu_in, t_in, spks_in, cond_in = x, mask, mu, t, spks, cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            if self.inference_cfg_rate > 0:
-                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            dphi_dt = self.velocity(x, t, mu, mask, spks, cond, cfg_inputs, attn_masks, t_embs[2 * step - 2], guided[step - 1], masked_norm)
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -127,9 +131,152 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1].float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, guided=None, masked_norm=False):
+        """Explicit midpoint solver, two estimator calls per step, second order. Arguments as solve_euler."""
+        cfg_inputs, attn_masks = self.cfg_inputs(x), self.attention_masks(x, mask)
+        t_embs = self.time_embedding_table(t_span)
+        guided = self.cfg_schedule(len(t_span) - 1) if guided is None else guided
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            k1 = self.velocity(x, t, mu, mask, spks, cond, cfg_inputs, attn_masks, t_embs[2 * step - 2], guided[step - 1], masked_norm)
+            k2 = self.velocity(x + 0.5 * dt * k1, t + 0.5 * dt, mu, mask, spks, cond, cfg_inputs, attn_masks, t_embs[2 * step - 1], guided[step - 1], masked_norm)
+            x = x + dt * k2
+        return x.float()
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, guided=None, masked_norm=False):
+        """Heun solver (trapezoidal predictor-corrector), two estimator calls per step, second order. Arguments as solve_euler."""
+        cfg_inputs, attn_masks = self.cfg_inputs(x), self.attention_masks(x, mask)
+        t_embs = self.time_embedding_table(t_span)
+        guided = self.cfg_schedule(len(t_span) - 1) if guided is None else guided
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            k1 = self.velocity(x, t, mu, mask, spks, cond, cfg_inputs, attn_masks, t_embs[2 * step - 2], guided[step - 1], masked_norm)
+            k2 = self.velocity(x + dt * k1, t + dt, mu, mask, spks, cond, cfg_inputs, attn_masks, t_embs[2 * step], guided[step - 1], masked_norm)
+            x = x + 0.5 * dt * (k1 + k2)
+        return x.float()
+
+    def solve_dpm_multistep(self, x, t_span, mu, mask, spks, cond, guided=None, masked_norm=False):
+        """Second order multistep solver in the spirit of DPM-Solver++(2M), one estimator call per step.
+
+        The velocity of the previous step is reused for a second order (Adams-Bashforth) update on the
+        non uniform t_span, the first step is an Euler step. Arguments as solve_euler.
+        """
+        cfg_inputs, attn_masks = self.cfg_inputs(x), self.attention_masks(x, mask)
+        t_embs = self.time_embedding_table(t_span)
+        guided = self.cfg_schedule(len(t_span) - 1) if guided is None else guided
+        prev_dphi_dt, prev_dt = None, None
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = self.velocity(x, t, mu, mask, spks, cond, cfg_inputs, attn_masks, t_embs[2 * step - 2], guided[step - 1], masked_norm)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                r = dt / prev_dt
+                x = x + dt * ((1 + 0.5 * r) * dphi_dt - 0.5 * r * prev_dphi_dt)
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x.float()
+
+    def cfg_schedule(self, n_timesteps, cfg_interval=None):
+        """Per step flag whether classifier-free guidance is applied.
+
+        With cfg_interval (start, end) step k is guided when start <= k / n_timesteps < end, e.g. (0, 0.5)
+        guides the first half of the steps. Unguided steps run the estimator with batch 1 instead of 2.
+        """
+        start, end = self.cfg_interval if cfg_interval is None else cfg_interval
+        if self.inference_cfg_rate <= 0:
+            return [False] * n_timesteps
+        if not isinstance(self.estimator, (torch.nn.Module, onnxruntime.InferenceSession)):
+            # the trt engine is built for the guided batch of 2 * batch_size
+            return [True] * n_timesteps
+        return [start <= k / n_timesteps < end for k in range(n_timesteps)]
+
+    def cfg_inputs(self, x):
+        """Estimator input buffers of batch 2 * batch_size for classifier-free guidance, None when it is disabled.
+
+        Rows [:batch_size] are conditioned, rows [batch_size:] keep zero mu, spks and cond.
+        """
+        if self.inference_cfg_rate > 0:
+            # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+            x_in = torch.zeros([2 * x.size(0), 80, x.size(2)], device=x.device, dtype=x.dtype)
+            mask_in = torch.zeros([2 * x.size(0), 1, x.size(2)], device=x.device, dtype=x.dtype)
+            mu_in = torch.zeros([2 * x.size(0), 80, x.size(2)], device=x.device, dtype=x.dtype)
+            t_in = torch.zeros([2 * x.size(0)], device=x.device, dtype=x.dtype)
+            spks_in = torch.zeros([2 * x.size(0), 80], device=x.device, dtype=x.dtype)
+            cond_in = torch.zeros([2 * x.size(0), 80, x.size(2)], device=x.device, dtype=x.dtype)
+            return x_in, mask_in, mu_in, t_in, spks_in, cond_in
+        return None
+
+    def attention_masks(self, x, mask):
+        """Decoder attention masks shared by all estimator calls of one solve, None for onnx/trt estimators."""
+        if not isinstance(self.estimator, torch.nn.Module) or not hasattr(self.estimator, 'attention_masks'):
+            return None
+        if self.inference_cfg_rate > 0:
+            mask = torch.concat([mask, mask], dim=0)
+        return self.estimator.attention_masks(mask, x.dtype)
+
+    def time_embedding_table(self, t_span):
+        """Decoder time embeddings of t_span and of its step midpoints, None for onnx/trt estimators.
+
+        Row 2k is t_span[k] and row 2k + 1 is t_span[k] + 0.5 * (t_span[k + 1] - t_span[k]), which covers
+        every time any solver queries. t_span only depends on n_timesteps and t_scheduler, so the table is
+        cached on the estimator per (n_timesteps, t_scheduler, dtype, device) and built on first use.
+        Only used without autograd, training keeps computing the embeddings in the estimator.
+        """
+        if not isinstance(self.estimator, torch.nn.Module) or not hasattr(self.estimator, 'time_embedding_cache') \
+                or torch.is_grad_enabled():
+            return [None] * (2 * len(t_span) - 1)
+        key = (len(t_span) - 1, self.t_scheduler, t_span.dtype, t_span.device)
+        if key not in self.estimator.time_embedding_cache:
+            t = torch.stack([t_span[:-1], t_span[:-1] + 0.5 * (t_span[1:] - t_span[:-1])], dim=1).flatten()
+            self.estimator.time_embedding_cache[key] = self.estimator.embed_time(torch.concat([t, t_span[-1:]]))
+        return self.estimator.time_embedding_cache[key]
+
+    def velocity(self, x, t, mu, mask, spks, cond, cfg_inputs=None, attn_masks=None, t_emb=None, guided=True, masked_norm=False):
+        """dphi/dt predicted by the estimator at (x, t), guided when inference_cfg_rate > 0 and guided is True.
+
+        Args:
+            t (torch.Tensor): current time, shape: (1,)
+            cfg_inputs (tuple, optional): buffers from cfg_inputs(x), reused by all calls of one solve
+            attn_masks (list, optional): decoder masks from attention_masks(x, mask), reused likewise
+            t_emb (torch.Tensor, optional): row of time_embedding_table(t_span) for t, shape: (time_embed_dim,)
+            guided (bool, optional): apply classifier-free guidance, from cfg_schedule()
+            masked_norm (bool, optional): passed to the estimator, see forward()
+        """
+        if self.inference_cfg_rate > 0 and guided:
+            # Classifier-Free Guidance inference introduced in VoiceBox
+            x_in, mask_in, mu_in, t_in, spks_in, cond_in = cfg_inputs
+            batch_size = x.size(0)
+            x_in[:batch_size] = x
+            x_in[batch_size:] = x
+            mask_in[:batch_size] = mask
+            mask_in[batch_size:] = mask
+            mu_in[:batch_size] = mu
+            t_in[:] = t.unsqueeze(0)
+            spks_in[:batch_size] = spks
+            cond_in[:batch_size] = cond
+            dphi_dt = self.forward_estimator(
+                x_in, mask_in,
+                mu_in, t_in,
+                spks_in,
+                cond_in,
+                attn_masks,
+                t_emb,
+                masked_norm
+            )
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+            return ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+        if self.inference_cfg_rate > 0 and attn_masks is not None:
+            # the masks were built for the guided batch, both halves are equal
+            attn_masks = [attn_mask[:x.size(0)] for attn_mask in attn_masks]
+        return self.forward_estimator(x, mask, mu, t, spks, cond, attn_masks, t_emb, masked_norm)
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, attn_masks=None, t_emb=None, masked_norm=False):
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator.forward(x, mask, mu, t, spks, cond)
+            # masked_norm is only passed when set, so estimators without the argument keep working unpadded
+            kwargs = {'masked_norm': True} if masked_norm else {}
+            if attn_masks is not None or t_emb is not None:
+                return self.estimator.forward(x, mask, mu, t, spks, cond, attn_masks=attn_masks, t_emb=t_emb, **kwargs)
+            return self.estimator.forward(x, mask, mu, t, spks, cond, **kwargs)
         elif isinstance(self.estimator, onnxruntime.InferenceSession):
             ort_inputs = {
                 'x': x.cpu().numpy(),
@@ -142,12 +289,12 @@ class ConditionalCFM(BASECFM):
             output = self.estimator.run(None, ort_inputs)[0]
             return torch.tensor(output, dtype=x.dtype, device=x.device)
         else:
-            self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-            self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-            self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-            self.estimator.set_input_shape('t', (2,))
-            self.estimator.set_input_shape('spks', (2, 80))
-            self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+            self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+            self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+            self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+            self.estimator.set_input_shape('t', (x.size(0),))
+            self.estimator.set_input_shape('spks', (x.size(0), 80))
+            self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
             # run trt engine
             self.estimator.execute_v2([x.contiguous().data_ptr(),
                                        mask.contiguous().data_ptr(),
@@ -206,7 +353,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None, cfg_interval=None):
         """Forward diffusion
 
         Args:
@@ -219,6 +366,8 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): name in ConditionalCFM.solvers. Defaults to cfm_params.solver.
+            cfg_interval (tuple, optional): guided fraction of the steps, see cfg_schedule(). Defaults to self.cfg_interval.
 
         Returns:
             sample: generated mel-spectrogram
@@ -232,4 +381,4 @@ class CausalConditionalCFM(ConditionalCFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_interval=cfg_interval), None
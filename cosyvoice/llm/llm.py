@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Tuple
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -36,10 +36,13 @@ class TransformerLM(torch.nn.Module):
             length_normalized_loss: bool = True,
             lsm_weight: float = 0.0,
             spk_embed_dim: int = 192,
+            static_kv_cache: bool = True,
     ):
         super().__init__()
         self.llm_input_size = llm_input_size
         self.speech_token_size = speech_token_size
+        # decode with a preallocated kv cache when the llm supports it (not available for jit llm)
+        self.static_kv_cache = static_kv_cache
         # 1. build text token inputs related modules
         self.text_embedding = torch.nn.Embedding(text_token_size, text_encoder_input_size)
         self.text_encoder = text_encoder
@@ -144,11 +147,15 @@ class TransformerLM(torch.nn.Module):
             sampling: int,
             ignore_eos: bool = True,
     ):
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-        return top_ids
+        # eos is excluded by its logit instead of resampling until another token comes out,
+        # for batched (B, V) scores ignore_eos may be a (B,) bool tensor
+        if isinstance(ignore_eos, torch.Tensor):
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[:, self.speech_token_size].masked_fill_(ignore_eos, -float('inf'))
+        elif ignore_eos:
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., self.speech_token_size] = -float('inf')
+        return self.sampling(weighted_scores, decoded_tokens, sampling)
 
     @torch.inference_mode()
     def inference(
@@ -197,11 +204,22 @@ class TransformerLM(torch.nn.Module):
         out_tokens = []
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        if self.static_kv_cache is True and hasattr(self.llm, 'forward_chunk_static'):
+            # keys/values of every step are written into one buffer instead of concatenated into a new cache
+            kv_cache = self.llm.new_static_cache(lm_input.size(1) + max_len, lm_input.device, lm_input.dtype)
+        else:
+            kv_cache = None
+        # only the prompt needs a causal mask, a single new token attends to the whole cache, (0, 0, 0) means fake mask
+        prefill_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+        step_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            att_mask = prefill_mask if i == 0 else step_mask
+            if kv_cache is not None:
+                y_pred = self.llm.forward_chunk_static(lm_input, offset=offset, kv_cache=kv_cache, att_mask=att_mask)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=att_mask)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             # force continue decode first token
             if i == 0:
@@ -215,6 +233,161 @@ class TransformerLM(torch.nn.Module):
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
+    @torch.inference_mode()
+    def inference_batch(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+    ) -> List[List[int]]:
+        """Decode several utterances in one batch, non-streaming.
+
+        Inputs are right padded along time with their lengths given, embedding is (B, D) or (0, D).
+        Decoder inputs are left padded so every sequence decodes at the same step, padding is
+        excluded by the attention mask and finished sequences are dropped from the batch.
+        Results match inference() when the llm uses relative positional encoding.
+        """
+        device = text.device
+        batch = text.size(0)
+        lm_input, key_mask = self.batch_lm_input(text, text_len, prompt_text, prompt_text_len,
+                                                 prompt_speech_token, prompt_speech_token_len, embedding)
+        text_len = text_len.cpu().tolist()
+
+        # 4. cal min/max_length
+        min_len = [int(text_len[i] * min_token_text_ratio) for i in range(batch)]
+        max_len = [int(text_len[i] * max_token_text_ratio) for i in range(batch)]
+
+        # 5. step by step decode, active maps batch rows to utterance index
+        out_tokens = [[] for _ in range(batch)]
+        active = list(range(batch))
+        # decoded tokens of the active rows on device, sampling runs on all rows at once
+        history = torch.zeros((batch, max(max_len, default=0)), dtype=torch.long, device=device)
+        offset = 0
+        att_cache = torch.zeros((0, 0, 0, 0, 0), device=device)
+        att_mask = torch.tril(torch.ones((1, lm_input.size(1), lm_input.size(1)), device=device)).to(torch.bool) & key_mask.unsqueeze(1)
+        for i in range(max(max_len, default=0)):
+            y_pred, att_cache = self.llm.forward_chunk_batch(lm_input, offset=offset, att_cache=att_cache, att_mask=att_mask)
+            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+            # force continue decode first token
+            if i == 0:
+                logp[:, self.speech_token_size] = -float('inf')
+            ignore_eos = torch.tensor([i < min_len[index] for index in active], device=device)
+            top_ids = self.sampling_ids(logp, history[:, :i], sampling, ignore_eos=ignore_eos)[:, 0]
+            history[:, i] = top_ids
+            keep, next_tokens = [], []
+            for row, top_ids in enumerate(top_ids.tolist()):
+                index = active[row]
+                if top_ids == self.speech_token_size or i >= max_len[index]:
+                    continue
+                out_tokens[index].append(top_ids)
+                keep.append(row)
+                next_tokens.append(top_ids)
+            if len(keep) == 0:
+                break
+            offset += lm_input.size(1)
+            if len(keep) != len(active):
+                rows = torch.tensor(keep, device=device)
+                att_cache, key_mask, history = att_cache[:, rows], key_mask[rows], history[rows]
+                active = [active[row] for row in keep]
+            key_mask = torch.concat([key_mask, key_mask.new_ones(len(active), 1)], dim=1)
+            att_mask = key_mask.unsqueeze(1)
+            lm_input = self.speech_embedding.weight[torch.tensor(next_tokens, device=device)].unsqueeze(dim=1)
+        return out_tokens
+
+    def batch_lm_input(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Build the left padded llm input of a batch, returns lm_input (B, T, D) and key_mask (B, T)."""
+        device = text.device
+        batch = text.size(0)
+        text_len, prompt_text_len = text_len.cpu().tolist(), prompt_text_len.cpu().tolist()
+        prompt_speech_token_len = prompt_speech_token_len.cpu().tolist()
+
+        # 1. encode prompt_text + text
+        text = [torch.concat([prompt_text[i, :prompt_text_len[i]], text[i, :text_len[i]]], dim=0) for i in range(batch)]
+        all_text_len = torch.tensor([i.size(0) for i in text], dtype=torch.int32, device=device)
+        text = self.text_embedding(pad_sequence(text, batch_first=True, padding_value=0))
+        text, all_text_len = self.encode(text, all_text_len)
+        all_text_len = all_text_len.cpu().tolist()
+
+        # 2. encode embedding
+        if embedding.shape[0] != 0:
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
+            embedding = embedding.unsqueeze(dim=1)
+        else:
+            embedding = torch.zeros(batch, 0, self.llm_input_size, dtype=text.dtype).to(device)
+
+        # 3. concat llm_input, left padded
+        sos_eos_emb = self.llm_embedding.weight[self.sos_eos].reshape(1, -1)
+        task_id_emb = self.llm_embedding.weight[self.task_id].reshape(1, -1)
+        prompt_speech_token_emb = self.speech_embedding(prompt_speech_token.clamp(min=0))
+        lm_input = [torch.concat([sos_eos_emb, embedding[i], text[i, :all_text_len[i]], task_id_emb,
+                                  prompt_speech_token_emb[i, :prompt_speech_token_len[i]]], dim=0) for i in range(batch)]
+        lm_input_len = torch.tensor([i.size(0) for i in lm_input], device=device)
+        lm_input = pad_sequence([i.flip(0) for i in lm_input], batch_first=True, padding_value=0).flip(1)
+        key_mask = torch.arange(lm_input.size(1), device=device).unsqueeze(0) >= (lm_input.size(1) - lm_input_len).unsqueeze(1)
+        return lm_input, key_mask
+
+    @torch.inference_mode()
+    def prefill(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run the llm over the prompt of one utterance, the first step of decode_step based decoding.
+
+        Returns logp of the first speech token (speech_token_size + 1,), eos already masked,
+        and the attention cache (elayers, 1, head, T, d_k * 2).
+        """
+        lm_input, _ = self.batch_lm_input(text, text_len, prompt_text, prompt_text_len,
+                                          prompt_speech_token, prompt_speech_token_len, embedding)
+        att_mask = torch.tril(torch.ones((1, lm_input.size(1), lm_input.size(1)), device=lm_input.device)).to(torch.bool)
+        y_pred, att_cache = self.llm.forward_chunk_batch(lm_input, offset=0,
+                                                         att_cache=torch.zeros((0, 0, 0, 0, 0), device=lm_input.device),
+                                                         att_mask=att_mask)
+        logp = self.llm_decoder(y_pred[0, -1]).log_softmax(dim=-1)
+        # force continue decode first token
+        logp[self.speech_token_size] = -float('inf')
+        return logp, att_cache
+
+    @torch.inference_mode()
+    def decode_step(
+            self,
+            tokens: List[int],
+            att_cache: torch.Tensor,
+            key_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Feed the last sampled token of every row of a decoding batch.
+
+        att_cache (elayers, B, head, T, d_k * 2) may hold rows of different lengths, left padded and
+        marked in key_mask (B, T). Returns logp (B, speech_token_size + 1) and the new attention
+        cache and key_mask, both one step longer.
+        """
+        lm_input = self.speech_embedding.weight[torch.tensor(tokens, device=att_cache.device)].unsqueeze(dim=1)
+        key_mask = torch.concat([key_mask, key_mask.new_ones(key_mask.size(0), 1)], dim=1)
+        y_pred, att_cache = self.llm.forward_chunk_batch(lm_input, offset=att_cache.size(3), att_cache=att_cache, att_mask=key_mask.unsqueeze(1))
+        return self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1), att_cache, key_mask
+
 
 class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
@@ -280,11 +453,15 @@ class Qwen2LM(torch.nn.Module):
             sampling: int,
             ignore_eos: bool = True,
     ):
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-        return top_ids
+        # eos is excluded by its logit instead of resampling until another token comes out,
+        # for batched (B, V) scores ignore_eos may be a (B,) bool tensor
+        if isinstance(ignore_eos, torch.Tensor):
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[:, self.speech_token_size].masked_fill_(ignore_eos, -float('inf'))
+        elif ignore_eos:
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., self.speech_token_size] = -float('inf')
+        return self.sampling(weighted_scores, decoded_tokens, sampling)
 
     @torch.inference_mode()
     def inference(
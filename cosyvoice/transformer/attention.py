@@ -196,6 +196,42 @@ class MultiHeadedAttention(nn.Module):
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
+    @torch.jit.unused
+    def forward_static(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        kv_cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """forward() with a preallocated KEY & VALUE cache.
+
+        Args:
+            kv_cache (torch.Tensor): Static cache (2, #batch, head, max_len, d_k)
+                holding the keys/values of positions [0, offset). The new ones
+                are written in place at [offset, offset + time1) and attention
+                runs over views of the filled part, so nothing is concatenated.
+            offset (int): Number of cached positions.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        q, k, v = self.forward_qkv(query, key, value)
+        end = offset + k.size(2)
+        kv_cache[0, :, :, offset:end] = k
+        kv_cache[1, :, :, offset:end] = v
+        k, v = kv_cache[0, :, :, :end], kv_cache[1, :, :, :end]
+        return self.forward_attention(v, self.attention_scores(q, k, pos_emb), mask)
+
+    @torch.jit.unused
+    def attention_scores(self, q: torch.Tensor, k: torch.Tensor, pos_emb: torch.Tensor) -> torch.Tensor:
+        """Scores (#batch, head, time1, time2) of q (#batch, head, time1, d_k) against k."""
+        return torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -328,3 +364,18 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             self.d_k)  # (batch, head, time1, time2)
 
         return self.forward_attention(v, scores, mask), new_cache
+
+    @torch.jit.unused
+    def attention_scores(self, q: torch.Tensor, k: torch.Tensor, pos_emb: torch.Tensor) -> torch.Tensor:
+        """Same scores as forward(), q is (#batch, head, time1, d_k)."""
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        n_batch_pos = pos_emb.size(0)
+        p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
+        p = p.transpose(1, 2)  # (batch, head, time1, d_k)
+        q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
+        q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+        matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+        if matrix_ac.shape != matrix_bd.shape:
+            matrix_bd = self.rel_shift(matrix_bd)
+        return (matrix_ac + matrix_bd) / math.sqrt(self.d_k)
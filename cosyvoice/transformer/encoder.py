@@ -271,6 +271,108 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def forward_chunk_batch(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+        att_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Batched version of forward_chunk for autoregressive decoding
+
+        All sequences share the same time axis, shorter ones are left padded
+        and excluded through att_mask. Only the attention cache is supported,
+        so this is meant for TransformerEncoder based models.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, time, mel-dim)
+            offset (int): current offset in encoder output time stamp
+            att_cache (torch.Tensor): cache tensor for KEY & VALUE with shape
+                (elayers, b, head, cache_t1, d_k * 2), or an empty tensor
+                for the first chunk
+            att_mask (torch.Tensor): mask with shape
+                (b, time, cache_t1 + time)
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, time, hidden-dim).
+            torch.Tensor: new attention cache with shape
+                (elayers, b, head, cache_t1 + time, d_k * 2)
+        """
+        tmp_masks = torch.ones(xs.size(0),
+                               1,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        elayers = att_cache.size(0)
+        cache_t1 = att_cache.size(3) if elayers > 0 else 0
+        pos_emb = self.embed.position_encoding(offset=offset - cache_t1,
+                                               size=cache_t1 + xs.size(1))
+        r_att_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, _ = layer(
+                xs,
+                att_mask,
+                pos_emb,
+                att_cache=att_cache[i] if elayers > 0 else torch.zeros((0, 0, 0, 0), device=xs.device))
+            r_att_cache.append(new_att_cache)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, torch.stack(r_att_cache, dim=0)
+
+    @torch.jit.unused
+    def new_static_cache(self, max_len: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """ Allocate a KEY & VALUE cache for forward_chunk_static
+
+        Returns:
+            torch.Tensor: zeros of shape (elayers, 2, b=1, head, max_len, d_k)
+        """
+        self_attn = self.encoders[0].self_attn
+        return torch.zeros((len(self.encoders), 2, 1, self_attn.h, max_len, self_attn.d_k), device=device, dtype=dtype)
+
+    @torch.jit.unused
+    def forward_chunk_static(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        kv_cache: torch.Tensor,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ forward_chunk with required_cache_size < 0 and a preallocated
+            attention cache
+
+        Keys and values of the chunk are written into kv_cache at
+        [offset, offset + time) in place, so the cost of a decoding step does
+        not grow with the copying of the whole cache. Only the attention cache
+        is supported, so this is meant for TransformerEncoder based models.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim)
+            offset (int): number of positions already in kv_cache
+            kv_cache (torch.Tensor): cache from new_static_cache, with shape
+                (elayers, 2, b=1, head, max_len, d_k)
+            att_mask (torch.Tensor): mask with shape (b=1, time, offset + time)
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, time, hidden-dim).
+        """
+        assert offset + xs.size(1) <= kv_cache.size(4), 'static cache is too short'
+        tmp_masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0, size=offset + xs.size(1))
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_static(xs, att_mask, pos_emb, kv_cache[i], offset)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
@@ -105,6 +105,43 @@ class TransformerEncoderLayer(nn.Module):
         fake_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         return x, mask, new_att_cache, fake_cnn_cache
 
+    @torch.jit.unused
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        kv_cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """forward() with a preallocated KEY & VALUE cache, see
+        MultiHeadedAttention.forward_static.
+
+        Args:
+            x (torch.Tensor): (#batch, time, size)
+            mask (torch.Tensor): Mask tensor (#batch, time, offset + time)
+            kv_cache (torch.Tensor): (2, #batch, head, max_len, d_k),
+                updated in place.
+            offset (int): Number of cached positions.
+        Returns:
+            torch.Tensor: Output tensor (#batch, time, size).
+
+        """
+        residual = x
+        if self.normalize_before:
+            x = self.norm1(x)
+        x = residual + self.dropout(self.self_attn.forward_static(x, x, x, mask, pos_emb, kv_cache, offset))
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm2(x)
+        return x
+
 
 class ConformerEncoderLayer(nn.Module):
     """Encoder layer module.
@@ -16,6 +16,7 @@
 """Unility functions for Transformer."""
 
 import random
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -107,33 +108,33 @@ def init_weights(m, mean=0.0, std=0.01):
 
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    """Sample with nucleus sampling, fall back to random sampling when the token repeats too often.
+
+    weighted_scores is (V,) with decoded_tokens a list of ints, or batched (B, V) with decoded_tokens
+    a (B, T) tensor of the tokens decoded so far on the same device. Returns top_ids (1,) or (B, 1).
+    """
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
+    if isinstance(decoded_tokens, torch.Tensor):
+        rep_num = (decoded_tokens[:, -win_size:] == top_ids).sum(dim=-1, keepdim=True)
+        return torch.where(rep_num >= win_size * tau_r, random_sampling(weighted_scores, decoded_tokens, sampling), top_ids)
+    if decoded_tokens[-win_size:].count(top_ids.item()) >= win_size * tau_r:
         top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
     return top_ids
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+    prob = weighted_scores.softmax(dim=-1)
+    # stable sort, so tied tokens keep their order and a row samples the same in a batch as on its own
+    sorted_value, sorted_idx = torch.sort(prob, dim=-1, descending=True, stable=True)
+    sorted_value, sorted_idx = sorted_value[..., :top_k], sorted_idx[..., :top_k]
+    # sampling both top-p and numbers, a token is kept while the probability before it is below top_p
+    keep = sorted_value.cumsum(dim=-1) - sorted_value < top_p
+    top_ids = sorted_idx.gather(-1, sorted_value.masked_fill(~keep, 0).multinomial(1, replacement=True))
     return top_ids
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
     return top_ids
 
 
@@ -148,6 +149,24 @@ def fade_in_out(fade_in_mel, fade_out_mel, window):
     return fade_in_mel.to(device)
 
 
+@lru_cache(maxsize=None)
+def hamming_window(length: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Symmetric Hamming window, same values as np.hamming(length), cached per (length, device, dtype)."""
+    return torch.hamming_window(length, periodic=False, dtype=torch.float64).to(device=device, dtype=dtype)
+
+
+def crossfade(fade_in: torch.Tensor, fade_out: torch.Tensor, overlap_len: int) -> torch.Tensor:
+    """Version of fade_in_out that stays on fade_in's device.
+
+    Blends the first overlap_len frames of fade_in with the last overlap_len frames of fade_out
+    using the two halves of a cached 2 * overlap_len Hamming window. The result is a new tensor,
+    fade_in may be an inference tensor and is not modified.
+    """
+    window = hamming_window(2 * overlap_len, fade_in.device, fade_in.dtype)
+    head = fade_in[..., :overlap_len] * window[:overlap_len] + fade_out[..., -overlap_len:].to(fade_in.device) * window[overlap_len:]
+    return torch.concat([head, fade_in[..., overlap_len:]], dim=-1)
+
+
 def set_all_random_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -0,0 +1,98 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from typing import Callable, Generator, Iterable, List
+
+_END = object()
+_STOPPED = object()
+
+
+class _StageError:
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def run_pipeline(source: Iterable, stages: List[Callable], queue_size: int = 2) -> Generator:
+    """Run stages concurrently, connected by bounded FIFO queues.
+
+    The source is iterated in its own thread, every stage but the last runs in its own thread and
+    the last stage runs in the caller, so item N + 1 can be in stage k while item N is in stage k + 1.
+    Each stage has a single worker, so results are yielded in source order. An exception in any
+    stage is re-raised in the caller; closing the generator stops all threads.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOPPED
+
+    def feed():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except BaseException as e:
+            put(queues[0], _StageError(e))
+            return
+        put(queues[0], _END)
+
+    def work(stage, q_in, q_out):
+        while True:
+            item = get(q_in)
+            if item is _STOPPED:
+                return
+            if item is _END or isinstance(item, _StageError):
+                put(q_out, item)
+                return
+            try:
+                result = stage(item)
+            except BaseException as e:
+                put(q_out, _StageError(e))
+                return
+            if not put(q_out, result):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages[:-1]):
+        threads.append(threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True))
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            if isinstance(item, _StageError):
+                raise item.error
+            yield stages[-1](item)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
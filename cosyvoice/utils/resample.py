@@ -0,0 +1,33 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from functools import lru_cache
+import torch
+import torchaudio
+
+
+@lru_cache(maxsize=32)
+def _get_resampler(orig_sr: int, new_sr: int, dtype: torch.dtype, device: str):
+    return torchaudio.transforms.Resample(orig_freq=orig_sr, new_freq=new_sr).to(device=device, dtype=dtype)
+
+
+def get_resampler(orig_sr: int, new_sr: int, dtype: torch.dtype = torch.float32, device='cpu'):
+    """Return a shared Resample module, its sinc kernel is built once per (orig_sr, new_sr, dtype, device)."""
+    return _get_resampler(int(orig_sr), int(new_sr), dtype, str(torch.device(device)))
+
+
+def resample(waveform: torch.Tensor, orig_sr: int, new_sr: int) -> torch.Tensor:
+    """Resample waveform of shape (..., time), any leading batch/channel dims are kept."""
+    if orig_sr == new_sr:
+        return waveform
+    return get_resampler(orig_sr, new_sr, waveform.dtype, waveform.device)(waveform)
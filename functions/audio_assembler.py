@@ -0,0 +1,55 @@
+import torch
+
+
+class AudioAssembler:
+    def __init__(self, sample_rate, channels=1, initial_seconds=30.0, dtype=torch.float32):
+        """
+        将生成器逐块输出的音频写入同一个预分配的缓冲区，容量不足时按倍数扩容，
+        避免逐块转换后再 torch.cat 造成的多次复制。
+
+        参数:
+        sample_rate (int): 采样率，用于计算初始容量。
+        channels (int): 声道数。
+        initial_seconds (float): 初始容量(秒)。
+        dtype (torch.dtype): 缓冲区数据类型。
+        """
+        self.sample_rate = sample_rate
+        self.buffer = torch.empty(channels, max(int(sample_rate * initial_seconds), 1), dtype=dtype)
+        self.length = 0
+
+    def append(self, chunk):
+        """
+        追加一块音频。
+
+        参数:
+        chunk (torch.Tensor): 形状为 (channels, samples) 的音频块。
+        """
+        chunk_len = chunk.shape[-1]
+        end = self.length + chunk_len
+        if end > self.buffer.shape[1]:
+            capacity = max(self.buffer.shape[1], 1)
+            while capacity < end:
+                capacity *= 2
+            buffer = torch.empty(self.buffer.shape[0], capacity, dtype=self.buffer.dtype)
+            buffer[:, :self.length] = self.buffer[:, :self.length]
+            self.buffer = buffer
+        self.buffer[:, self.length:end] = chunk
+        self.length = end
+
+    def waveform(self):
+        """
+        返回已写入的音频。缓冲区先裁剪到已写入长度(只复制一次)，返回的张量不再引用多余的预分配空间，
+        之后继续 append() 会重新分配缓冲区，不会改动已返回的张量。
+
+        返回:
+        torch.Tensor: 形状为 (channels, samples) 的音频。
+        """
+        if self.length < self.buffer.shape[1]:
+            self.buffer = self.buffer[:, :self.length].clone()
+        return self.buffer
+
+    def duration(self):
+        """
+        返回已写入音频的时长(秒)。
+        """
+        return self.length / self.sample_rate
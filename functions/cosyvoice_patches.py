@@ -5,30 +5,111 @@ from tqdm import tqdm
 import config
 from cosyvoice.cli.cosyvoice import CosyVoice
 from cosyvoice.utils.file_utils import logging
+from functions.prompt_bundle import make_prompt_bundle, upgrade_prompt_bundle
 
 class CosyVoicePatches(CosyVoice):
-    def __init__(self, model_dir):
-        super().__init__(model_dir)
+    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True):
+        super().__init__(model_dir, load_jit=load_jit, load_onnx=load_onnx, fp16=fp16)
+        self.pipeline = config.SYNTHESIS_PIPELINE
+        if config.LLM_CONTINUOUS_BATCHING > 0:
+            self.model.enable_llm_scheduler(max_batch_size=config.LLM_CONTINUOUS_BATCHING)
 
-    def inference_sft_with_speaker_model(self, tts_text, speaker_model, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
-            model_input = self.__frontend_sft(i, speaker_model)
+    def inference_sft_with_speaker_model(self, tts_text, speaker_model, stream=False, speed=1.0, text_frontend=True, stream_options=None, flow_options=None):
+        def model_inputs():
+            for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
+                logging.info("\nsynthesis text {}".format(i))
+                yield self.__frontend_sft(i, speaker_model)
+        yield from self.synthesize(model_inputs(), stream=stream, speed=speed, stream_options=stream_options, flow_options=flow_options)
+    
+    def inference_zero_shot_from_bundle(self, tts_text, bundle, stream=False, speed=1.0, text_frontend=True, stream_options=None, flow_options=None):
+        """
+        使用提示包进行 3 秒音色克隆合成。提示 token、梅尔特征和 embedding 均来自提示包，
+        跳过所有前端音频处理，只需对合成文本分词。
+        """
+        bundle = upgrade_prompt_bundle(bundle, self.sample_rate)
+        if bundle['sample_rate'] != self.sample_rate:
+            raise ValueError("说话人模型采样率 {} 与当前模型采样率 {} 不一致".format(bundle['sample_rate'], self.sample_rate))
+        def model_inputs():
+            for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+                logging.info("\nsynthesis text {}".format(i))
+                yield self.__frontend_bundle(i, bundle)
+        yield from self.synthesize(model_inputs(), stream=stream, speed=speed, stream_options=stream_options, flow_options=flow_options)
+
+    def inference_batch(self, requests, speed=1.0, batch_size=8, text_frontend=True, flow_options=None):
+        """
+        批量合成多条文本，LLM 以批量方式解码，非流式。
+
+        参数:
+        requests (list): (tts_text, speaker) 列表，speaker 为预训练音色名称或说话人模型(提示包)。
+        speed (float): 语速。
+        batch_size (int): 每批解码的分句数。
+        text_frontend (bool): 是否进行文本正则化。
+        flow_options (dict): flow 推理参数，如 {'n_timesteps': 5, 'solver': 'heun'}。
+
+        返回:
+        list: 与 requests 一一对应，每项为该条文本各分句的输出字典列表。
+        """
+        segments = []
+        for index, (tts_text, speaker) in enumerate(requests):
+            if not isinstance(speaker, str):
+                speaker = upgrade_prompt_bundle(speaker, self.sample_rate)
+            for i in self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend):
+                if isinstance(speaker, str):
+                    model_input = self.frontend.frontend_sft(i, speaker)
+                else:
+                    model_input = self.__frontend_bundle(i, speaker)
+                segments.append((index, model_input))
 
+        # 按文本长度排序后分批，减少填充
+        order = sorted(range(len(segments)), key=lambda k: segments[k][1]['text'].shape[1])
+        outputs = [None] * len(segments)
+        for start in tqdm(range(0, len(order), batch_size)):
+            batch = order[start:start + batch_size]
             start_time = time.time()
-            logging.info("\nsynthesis text {}".format(i))
+            for k, model_output in zip(batch, self.model.tts_batch([segments[k][1] for k in batch], speed=speed, flow_options=flow_options)):
+                outputs[k] = model_output
+            speech_len = sum(outputs[k]['tts_speech'].shape[1] for k in batch) / self.sample_rate
+            logging.info("\nbatch of {} segments, speech len {}, rtf {}".format(len(batch), speech_len, (time.time() - start_time) / speech_len))
+
+        results = [[] for _ in requests]
+        for (index, _), model_output in zip(segments, outputs):
+            results[index].append(model_output)
+        return results
+
+    def frontend_speaker_model(self, prompt_text, prompt_speech_16k, text_frontend=True):
+        """
+        根据参考音频构建说话人模型(提示包)。与 inference_zero_shot 使用相同的提示特征缓存，
+        合成之后调用时直接复用已提取的特征，不会再次运行 ONNX 提取。
+        """
+        prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
+        prompt = self.frontend._extract_prompt(prompt_text, prompt_speech_16k, self.sample_rate)
+        return make_prompt_bundle(prompt, self.sample_rate)
+
+    def __frontend_bundle(self, tts_text, bundle):
+        tts_text_token, tts_text_token_len = self.frontend._extract_text_token(tts_text)
+        model_input = {
+            'text': tts_text_token,
+            'text_len': tts_text_token_len,
+            'prompt_text': bundle['prompt_text'],
+            'prompt_text_len': bundle['prompt_text_len'],
+            'llm_prompt_speech_token': bundle['prompt_speech_token'],
+            'llm_prompt_speech_token_len': bundle['prompt_speech_token_len'],
+            'flow_prompt_speech_token': bundle['prompt_speech_token'],
+            'flow_prompt_speech_token_len': bundle['prompt_speech_token_len'],
+            'prompt_speech_feat': bundle['prompt_speech_feat'],
+            'prompt_speech_feat_len': bundle['prompt_speech_feat_len'],
+            'llm_embedding': bundle['embedding'],
+            'flow_embedding': bundle['embedding']
+            }
+        return model_input
 
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / config.AUDIO_TARGET_SAMPLE_RATE
-                logging.info("\nyield speech len {}, rtf {}".format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-    
     def __frontend_sft(self, tts_text, speaker_model):
+        speaker_model = upgrade_prompt_bundle(speaker_model, self.sample_rate)
         tts_text_token, tts_text_token_len = self.frontend._extract_text_token(tts_text)
         model_input = {
             'text': tts_text_token,
             'text_len': tts_text_token_len,
-            'llm_embedding': speaker_model["llm_embedding"],
-            'flow_embedding': speaker_model["flow_embedding"]
+            'llm_embedding': speaker_model["embedding"],
+            'flow_embedding': speaker_model["embedding"]
             }
         return model_input
\ No newline at end of file
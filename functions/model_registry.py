@@ -0,0 +1,347 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+import config
+from cosyvoice.utils.file_utils import logging
+from functions.cosyvoice_patches import CosyVoicePatches
+from functions.utils import get_device
+
+
+class ModelRegistry:
+    def __init__(self, max_memory_mb=config.MODEL_CACHE_MAX_MEMORY_MB, cold_tier=config.MODEL_CACHE_COLD_TIER,
+                 cold_dir=config.MODEL_CACHE_COLD_DIR):
+        """
+        进程级 CosyVoice 模型注册表，按 (model_dir, device, precision) 缓存已加载的模型。
+
+        超出内存预算时按最近最少使用(LRU)顺序淘汰模型。开启冷存储后，被淘汰模型的权重
+        写入磁盘并以 mmap 方式挂回模型，不再常驻内存，再次使用时直接从冷存储恢复，
+        无需重新解析配置和构建模型。get() 返回的模型计入占用，调用 release() 前不会被淘汰。
+
+        参数:
+        max_memory_mb (int): 常驻模型的内存预算(MB)，0 表示不限制。
+        cold_tier (bool): 淘汰时是否转入冷存储而不是完全释放。
+        cold_dir (str): 冷存储权重文件目录。
+        """
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.cold_tier = cold_tier
+        self.cold_dir = cold_dir
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def make_key(model_dir, fp16=True):
+        """
+        生成模型缓存键。CPU 不支持 fp16，与 CosyVoice 的实际加载行为保持一致。
+
+        参数:
+        model_dir (str): 模型目录。
+        fp16 (bool): 是否请求半精度。
+
+        返回:
+        tuple: (model_dir, device, precision)
+        """
+        device = get_device()
+        precision = "fp16" if fp16 and device.type == "cuda" else "fp32"
+        return (model_dir, str(device), precision)
+
+    def get(self, model_dir, fp16=True):
+        """
+        返回已预热的模型实例，未加载时才构建，处于冷存储时先恢复。同一模型并发请求只会加载一次。
+        返回的模型计入占用(不会被淘汰或转入冷存储)，使用完毕后需调用 release()。
+
+        参数:
+        model_dir (str): 模型目录。
+        fp16 (bool): 是否请求半精度。
+
+        返回:
+        CosyVoicePatches: 模型实例。
+        """
+        key = self.make_key(model_dir, fp16)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None and entry["cold_path"] is None and not entry["offloading"]:
+                self._models.move_to_end(key)
+                entry["in_use"] += 1
+                return entry["model"]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                entry = self._models.get(key)
+            if entry is None:
+                logging.info("loading cosyvoice model {}".format(key))
+                model = CosyVoicePatches(model_dir, fp16=fp16)
+                entry = {"model": model, "size": self.estimate_size(model), "cold_path": None, "offloading": False, "in_use": 0,
+                         "unload": False}
+            elif entry["cold_path"] is not None:
+                logging.info("restoring cosyvoice model {} from cold tier".format(key))
+                self._restore(entry)
+
+            with self._lock:
+                self._models[key] = entry
+                self._models.move_to_end(key)
+                entry["in_use"] += 1
+                victims = self._select_victims(keep=key)
+
+        self._evict(victims)
+        return entry["model"]
+
+    def release(self, cosyvoice):
+        """
+        结束一次 get() 的占用。占用期间超出内存预算而未能淘汰的模型、以及占用期间被请求卸载的模型
+        在此时补做淘汰或卸载。
+
+        参数:
+        cosyvoice (CosyVoicePatches): get() 返回的模型实例。
+        """
+        unloads = []
+        with self._lock:
+            for key, entry in self._models.items():
+                if entry["model"] is cosyvoice and entry["in_use"] > 0:
+                    entry["in_use"] -= 1
+                    if entry["in_use"] == 0 and entry["unload"]:
+                        unloads.append((key, self._models.pop(key)))
+                    break
+            victims = self._select_victims(keep=None)
+        entry = None
+        self._unload(unloads)
+        self._evict(victims)
+
+    @contextmanager
+    def use(self, model_dir, fp16=True):
+        """
+        在 with 语句内占用模型，退出时自动 release()。
+
+        参数:
+        model_dir (str): 模型目录。
+        fp16 (bool): 是否请求半精度。
+        """
+        cosyvoice = self.get(model_dir, fp16)
+        try:
+            yield cosyvoice
+        finally:
+            self.release(cosyvoice)
+
+    def unload(self, model_dir, fp16=True):
+        """
+        卸载指定模型，包括其冷存储文件。正在使用或正在转入冷存储的模型推迟到使用结束后卸载。
+
+        参数:
+        model_dir (str): 模型目录。
+        fp16 (bool): 是否请求半精度。
+
+        返回:
+        bool: 模型是否曾被加载。
+        """
+        key = self.make_key(model_dir, fp16)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                return False
+            if entry["in_use"] > 0 or entry["offloading"]:
+                entry["unload"] = True
+                logging.info("cosyvoice model {} is in use, unloading it once released".format(key))
+                return True
+            unloads = [(key, self._models.pop(key))]
+        entry = None
+        self._unload(unloads)
+        return True
+
+    def unload_all(self):
+        """
+        卸载所有已加载的模型，包括冷存储中的模型。正在使用的模型推迟到使用结束后卸载。
+
+        返回:
+        int: 卸载(含推迟卸载)的模型数量。
+        """
+        unloads, deferred = [], 0
+        with self._lock:
+            for key, entry in list(self._models.items()):
+                if entry["in_use"] > 0 or entry["offloading"]:
+                    entry["unload"] = True
+                    deferred += 1
+                else:
+                    unloads.append((key, self._models.pop(key)))
+        entry = None
+        return self._unload(unloads) + deferred
+
+    def memory_usage(self):
+        """
+        返回当前常驻内存的模型估算占用(字节)，冷存储中的模型不计入。
+        """
+        with self._lock:
+            return self._resident_size()
+
+    def loaded_models(self):
+        """
+        返回已加载模型的缓存键及所处层级，按最近最少使用到最近使用排列。
+
+        返回:
+        list: [(key, "warm" | "cold"), ...]
+        """
+        with self._lock:
+            return [(key, "warm" if entry["cold_path"] is None else "cold") for key, entry in self._models.items()]
+
+    @staticmethod
+    def estimate_size(cosyvoice):
+        """
+        估算模型常驻内存的字节数，包括 LLM、flow、HiFT 的参数与缓冲区，以及 ONNX 会话。
+        ONNX 会话无法直接统计，按模型文件大小估算。
+
+        参数:
+        cosyvoice (CosyVoice): 模型实例。
+
+        返回:
+        int: 估算字节数。
+        """
+        size = sum(tensor.numel() * tensor.element_size() for _, tensor in ModelRegistry._named_tensors(cosyvoice))
+        model_dir = cosyvoice.model_dir
+        onnx_files = ["campplus.onnx", "speech_tokenizer_v1.onnx", "speech_tokenizer_v2.onnx"]
+        if not isinstance(cosyvoice.model.flow.decoder.estimator, torch.nn.Module):
+            onnx_files.append("flow.decoder.estimator.fp32.onnx")
+        for file_name in onnx_files:
+            path = os.path.join(model_dir, file_name)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        return size
+
+    @staticmethod
+    def _named_tensors(cosyvoice):
+        for prefix, module in (("llm", cosyvoice.model.llm), ("flow", cosyvoice.model.flow), ("hift", cosyvoice.model.hift)):
+            for name, tensor in module.named_parameters():
+                yield "{}.{}".format(prefix, name), tensor
+            for name, tensor in module.named_buffers():
+                yield "{}.{}".format(prefix, name), tensor
+
+    def _resident_size(self):
+        return sum(entry["size"] for entry in self._models.values() if entry["cold_path"] is None)
+
+    def _select_victims(self, keep):
+        # 调用方需持有 self._lock；从最近最少使用的一端开始挑选，刚使用的模型和正在使用的模型始终保留
+        if self.max_memory_bytes <= 0:
+            return []
+        victims = []
+        total = self._resident_size()
+        for key, entry in self._models.items():
+            if total <= self.max_memory_bytes:
+                break
+            if key == keep or entry["cold_path"] is not None or entry["offloading"] or entry["in_use"] > 0:
+                continue
+            victims.append(key)
+            total -= entry["size"]
+        if not self.cold_tier:
+            victims = [(key, self._models.pop(key)) for key in victims]
+        else:
+            victims = [(key, self._models[key]) for key in victims]
+        return victims
+
+    def _evict(self, victims):
+        if not victims:
+            return
+        unloads = []
+        for key, entry in victims:
+            if not self.cold_tier:
+                logging.info("evicting cosyvoice model {} to respect memory budget".format(key))
+                self._shutdown(entry["model"])
+                continue
+            with self._key_locks[key]:
+                with self._lock:
+                    # 挑选之后可能又被 get() 占用；offloading 期间 get() 走加锁路径，等待转存完成后再恢复
+                    if self._models.get(key) is not entry or entry["cold_path"] is not None or entry["in_use"] > 0:
+                        continue
+                    entry["offloading"] = True
+                logging.info("offloading cosyvoice model {} to cold tier".format(key))
+                try:
+                    self._shutdown(entry["model"])
+                    self._offload(key, entry)
+                finally:
+                    with self._lock:
+                        entry["offloading"] = False
+                        # 转存期间被请求卸载
+                        if entry["unload"] and entry["in_use"] == 0 and self._models.get(key) is entry:
+                            unloads.append((key, self._models.pop(key)))
+        del victims, entry
+        self._unload(unloads)
+        self._release()
+
+    def _offload(self, key, entry):
+        # 权重写入磁盘后以 mmap 方式挂回，页面由操作系统按需换入换出
+        os.makedirs(self.cold_dir, exist_ok=True)
+        path = os.path.join(self.cold_dir, "{}_{}_{}.pt".format(os.path.basename(key[0].rstrip("/\\")),
+                                                               key[1].replace(":", ""), key[2]))
+        tensors = dict(self._named_tensors(entry["model"]))
+        torch.save({name: tensor.detach().cpu() for name, tensor in tensors.items()}, path)
+        cold_state = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        for name, tensor in tensors.items():
+            tensor.data = cold_state[name]
+        entry["cold_path"] = path
+
+    def _restore(self, entry):
+        device = get_device()
+        state = torch.load(entry["cold_path"], map_location=device, weights_only=True)
+        for name, tensor in self._named_tensors(entry["model"]):
+            tensor.data = state[name]
+        cold_path, entry["cold_path"] = entry["cold_path"], None
+        del state
+        gc.collect()
+        self._remove_file(cold_path)
+
+    def _unload(self, unloads):
+        # unloads 为已移出注册表的 (key, entry)，逐个取出，调用方的列表随之清空，不再持有模型引用
+        cold_paths = []
+        while unloads:
+            key, entry = unloads.pop()
+            logging.info("unloading cosyvoice model {}".format(key))
+            self._shutdown(entry["model"])
+            cold_paths.append(entry["cold_path"])
+            entry = None
+        if cold_paths:
+            self._release()
+        for cold_path in cold_paths:
+            self._remove_file(cold_path)
+        return len(cold_paths)
+
+    @staticmethod
+    def _shutdown(cosyvoice):
+        # 停止模型的后台 LLM 调度线程，线程持有 LLM 的引用，不停止则权重无法释放；之后的请求会重新启动线程
+        shutdown = getattr(cosyvoice.model, "shutdown", None)
+        if shutdown is not None:
+            shutdown()
+
+    @staticmethod
+    def _remove_file(path):
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning("failed to remove cold tier file {}: {}".format(path, e))
+
+    @staticmethod
+    def _release():
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+model_registry = ModelRegistry()
+
+
+def load_cosyvoice(model_dir, fp16=True):
+    """
+    从进程级注册表中获取 CosyVoice 模型实例，用于 with 语句，期间模型不会被淘汰或转入冷存储。
+
+    参数:
+    model_dir (str): 模型目录。
+    fp16 (bool): 是否请求半精度。
+
+    返回:
+    上下文管理器，进入时得到 CosyVoicePatches 模型实例。
+    """
+    return model_registry.use(model_dir, fp16)
@@ -0,0 +1,74 @@
+import torch
+
+import config
+
+'''提示包格式版本，格式变化时递增'''
+PROMPT_BUNDLE_VERSION = 1
+
+'''提示包中的张量字段'''
+PROMPT_BUNDLE_TENSOR_KEYS = (
+    'prompt_text', 'prompt_text_len',
+    'prompt_speech_token', 'prompt_speech_token_len',
+    'prompt_speech_feat', 'prompt_speech_feat_len',
+    'embedding',
+)
+
+
+def make_prompt_bundle(prompt, sample_rate=config.AUDIO_TARGET_SAMPLE_RATE):
+    """
+    由前端提取的提示特征构建提示包(SPEAKER_MODEL)。
+
+    参数:
+    prompt (dict): CosyVoiceFrontEnd._extract_prompt 的返回值。
+    sample_rate (int): 提示梅尔特征对应的采样率。
+
+    返回:
+    dict: 提示包。
+    """
+    return {
+        'version': PROMPT_BUNDLE_VERSION,
+        'sample_rate': sample_rate,
+        'prompt_text': prompt['prompt_text'],
+        'prompt_text_len': prompt['prompt_text_len'],
+        'prompt_speech_token': prompt['speech_token'],
+        'prompt_speech_token_len': prompt['speech_token_len'],
+        'prompt_speech_feat': prompt['speech_feat'],
+        'prompt_speech_feat_len': prompt['speech_feat_len'],
+        'embedding': prompt['embedding'],
+    }
+
+
+def upgrade_prompt_bundle(speaker_model, sample_rate=config.AUDIO_TARGET_SAMPLE_RATE):
+    """
+    将旧版说话人模型转换为当前版本的提示包。旧版只含 embedding 时，提示 token 与梅尔特征为空，
+    合成效果等同于预训练音色方式。
+
+    参数:
+    speaker_model (dict): 说话人模型或提示包。
+    sample_rate (int): 旧版模型默认的采样率。
+
+    返回:
+    dict: 提示包。
+    """
+    version = speaker_model.get('version', 0)
+    if version > PROMPT_BUNDLE_VERSION:
+        raise ValueError("不支持的说话人模型版本 {}，当前版本 {}".format(version, PROMPT_BUNDLE_VERSION))
+    if version == PROMPT_BUNDLE_VERSION:
+        return speaker_model
+
+    embedding = speaker_model['flow_embedding']
+    device = embedding.device
+    empty_token = torch.zeros(1, 0, dtype=torch.int32, device=device)
+    empty_len = torch.zeros(1, dtype=torch.int32, device=device)
+    return {
+        'version': PROMPT_BUNDLE_VERSION,
+        'sample_rate': sample_rate,
+        'prompt_text': speaker_model.get('prompt_text', empty_token),
+        'prompt_text_len': speaker_model.get('prompt_text_len', empty_len),
+        'prompt_speech_token': speaker_model.get('llm_prompt_speech_token', empty_token),
+        'prompt_speech_token_len': speaker_model.get('llm_prompt_speech_token_len', empty_len),
+        'prompt_speech_feat': speaker_model.get('prompt_speech_feat', torch.zeros(1, 0, 80, device=device)),
+        'prompt_speech_feat_len': speaker_model.get('prompt_speech_feat_len', empty_len),
+        'embedding': embedding,
+    }
+
@@ -0,0 +1,271 @@
+import os
+import glob
+import json
+import time
+import threading
+
+import numpy as np
+import torch
+
+from cosyvoice.utils.file_utils import logging
+from functions.prompt_bundle import PROMPT_BUNDLE_TENSOR_KEYS, upgrade_prompt_bundle
+from functions.utils import get_speaker_folders
+
+'''索引文件格式版本'''
+SPEAKER_INDEX_VERSION = 1
+
+'''张量在数据文件中的对齐字节数'''
+SPEAKER_BLOB_ALIGNMENT = 64
+
+'''数据文件支持的张量类型'''
+SPEAKER_BLOB_DTYPES = ('float16', 'float32', 'float64', 'int32', 'int64')
+
+
+class SpeakerLibrary:
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root):
+        """
+        说话人库：一个索引文件(名称 → 偏移、形状、类型、修改时间)加一个内存映射的张量数据文件。
+
+        列出说话人只读取缓存的索引；加载说话人时直接对映射文件切片，不复制数据。
+        新增说话人追加写入数据文件，删除只修改索引，空间由 compact() 回收。
+
+        参数:
+        root (str): 说话人库目录。
+        """
+        self.root = root
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self._lock = threading.RLock()
+        self._index = None
+        self._index_mtime = None
+        self._blob = None
+        self._blob_key = None
+        self._cache = {}
+
+    def names(self):
+        """
+        返回说话人名称列表。
+
+        返回:
+        list: 按名称排序的说话人列表。
+        """
+        with self._lock:
+            index = self._load_index()
+            return sorted(index["speakers"].keys())
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._load_index()["speakers"]
+
+    def get(self, name, device="cpu"):
+        """
+        加载说话人提示包。CPU 上的张量直接引用映射文件，其他设备时复制一次。
+
+        参数:
+        name (str): 说话人名称。
+        device (torch.device | str): 目标设备。
+
+        返回:
+        dict: 提示包。
+        """
+        device = torch.device(device)
+        with self._lock:
+            index = self._load_index()
+            record = index["speakers"].get(name)
+            if record is None:
+                raise KeyError("Speaker model {} is not exist".format(name))
+            cache_key = (name, str(device))
+            cached = self._cache.get(cache_key)
+            if cached is not None and cached[0] == record["mtime"]:
+                return cached[1]
+
+            blob = self._open_blob(index)
+            bundle = dict(record["meta"])
+            for key, info in record["tensors"].items():
+                dtype = np.dtype(info["dtype"])
+                nbytes = int(np.prod(info["shape"], dtype=np.int64)) * dtype.itemsize
+                array = blob[info["offset"]:info["offset"] + nbytes].view(dtype).reshape(info["shape"])
+                bundle[key] = torch.from_numpy(array).to(device)
+            self._cache[cache_key] = (record["mtime"], bundle)
+            return bundle
+
+    def add(self, name, bundle):
+        """
+        新增或覆盖说话人。张量追加写入数据文件，索引原子替换。
+
+        参数:
+        name (str): 说话人名称。
+        bundle (dict): 提示包或旧版说话人模型。
+        """
+        with self._lock:
+            index = self._load_index()
+            self._append(index, name, bundle)
+            self._write_index(index)
+            self._drop_cache(name)
+
+    def remove(self, name):
+        """
+        删除说话人。只修改索引，数据文件中的空间由 compact() 回收。
+
+        参数:
+        name (str): 说话人名称。
+
+        返回:
+        bool: 说话人是否存在。
+        """
+        with self._lock:
+            index = self._load_index()
+            if index["speakers"].pop(name, None) is None:
+                return False
+            self._write_index(index)
+            self._drop_cache(name)
+            return True
+
+    def compact(self):
+        """
+        重写数据文件，回收已删除或被覆盖说话人占用的空间。
+
+        之前 get() 返回的张量仍映射着旧数据文件，数据保持有效；旧文件无法删除时(Windows 下仍被映射)
+        记入索引，下次 compact() 时再删除。
+        """
+        with self._lock:
+            index = self._load_index()
+            bundles = {name: self.get(name) for name in index["speakers"]}
+            generation = index.get("generation", 0) + 1
+            index = {"version": SPEAKER_INDEX_VERSION, "generation": generation,
+                     "blob": "speakers.{}.bin".format(generation), "speakers": {},
+                     "stale_blobs": index.get("stale_blobs", []) + [index["blob"]]}
+            for name, bundle in bundles.items():
+                self._append(index, name, bundle)
+            self._write_index(index)
+            del bundles
+            self._cache.clear()
+            self._blob, self._blob_key = None, None
+            self._remove_stale_blobs(index)
+
+    def import_legacy(self, directory=None):
+        """
+        将目录中旧版的单文件说话人模型(.pt)导入说话人库，已存在的名称会跳过。
+
+        参数:
+        directory (str): 旧版模型目录，默认为说话人库目录。
+
+        返回:
+        int: 导入的说话人数量。
+        """
+        directory = directory or self.root
+        count = 0
+        with self._lock:
+            index = self._load_index()
+            for file in glob.glob(os.path.join(directory, "**", "*.pt"), recursive=True):
+                name = os.path.splitext(os.path.basename(file))[0]
+                if name in index["speakers"]:
+                    continue
+                try:
+                    self._append(index, name, torch.load(file, map_location="cpu"))
+                    count += 1
+                except Exception as e:
+                    logging.warning("failed to import speaker model {}: {}".format(file, e))
+            self._write_index(index)
+        return count
+
+    def _append(self, index, name, bundle):
+        # 调用方需持有 self._lock；张量按对齐偏移追加到数据文件，只更新内存中的索引
+        bundle = upgrade_prompt_bundle(bundle)
+        os.makedirs(self.root, exist_ok=True)
+        blob_path = os.path.join(self.root, index["blob"])
+        record = {"mtime": time.time(), "meta": {}, "tensors": {}}
+        with open(blob_path, "ab") as f:
+            offset = f.tell()
+            for key, value in bundle.items():
+                if key not in PROMPT_BUNDLE_TENSOR_KEYS:
+                    record["meta"][key] = value
+                    continue
+                array = value.detach().cpu().contiguous().numpy()
+                if array.dtype.name not in SPEAKER_BLOB_DTYPES:
+                    raise ValueError("unsupported dtype {} for {}".format(array.dtype, key))
+                padding = -offset % SPEAKER_BLOB_ALIGNMENT
+                f.write(b"\0" * padding)
+                offset += padding
+                record["tensors"][key] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.name}
+                f.write(array.tobytes())
+                offset += array.nbytes
+        index["speakers"][name] = record
+
+    def _load_index(self):
+        # 调用方需持有 self._lock；索引文件被其他进程修改时重新读取
+        mtime = os.path.getmtime(self.index_path) if os.path.exists(self.index_path) else None
+        if self._index is not None and mtime == self._index_mtime:
+            return self._index
+        if mtime is None:
+            index = {"version": SPEAKER_INDEX_VERSION, "generation": 0, "blob": "speakers.0.bin", "speakers": {}}
+        else:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version", 0) > SPEAKER_INDEX_VERSION:
+                raise ValueError("不支持的说话人库版本 {}".format(index.get("version")))
+        self._index, self._index_mtime = index, mtime
+        return index
+
+    def _write_index(self, index):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+        self._index, self._index_mtime = index, os.path.getmtime(self.index_path)
+
+    def _remove_stale_blobs(self, index):
+        # 调用方需持有 self._lock；删除失败的文件保留在索引中
+        stale_blobs = []
+        for blob in index["stale_blobs"]:
+            blob_path = os.path.join(self.root, blob)
+            try:
+                if os.path.exists(blob_path):
+                    os.remove(blob_path)
+            except OSError as e:
+                logging.warning("old speaker blob {} is still mapped, removing it on the next compact(): {}".format(blob_path, e))
+                stale_blobs.append(blob)
+        if stale_blobs != index["stale_blobs"]:
+            index["stale_blobs"] = stale_blobs
+            self._write_index(index)
+
+    def _open_blob(self, index):
+        blob_path = os.path.join(self.root, index["blob"])
+        blob_key = (blob_path, os.path.getsize(blob_path))
+        if self._blob_key != blob_key:
+            # 写时复制模式：张量可写但不会改动文件，避免 torch.from_numpy 的只读警告
+            self._blob = np.memmap(blob_path, dtype=np.uint8, mode="c")
+            self._blob_key = blob_key
+        return self._blob
+
+    def _drop_cache(self, name):
+        for key in [key for key in self._cache if key[0] == name]:
+            del self._cache[key]
+
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+
+def get_speaker_library(root=None):
+    """
+    返回进程内共享的说话人库实例。首次打开且没有索引时，导入目录中旧版的 .pt 说话人模型。
+
+    参数:
+    root (str): 说话人库目录，默认为说话人模型目录。
+
+    返回:
+    SpeakerLibrary: 说话人库。
+    """
+    root = root or get_speaker_folders()
+    with _libraries_lock:
+        library = _libraries.get(root)
+        if library is None:
+            library = SpeakerLibrary(root)
+            if not os.path.exists(library.index_path) and os.path.isdir(root):
+                count = library.import_legacy(root)
+                logging.info("imported {} legacy speaker models into {}".format(count, root))
+            _libraries[root] = library
+        return library
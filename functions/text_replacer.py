@@ -1,3 +1,123 @@
+import os
+import threading
+from collections import deque
+
+
+class AhoCorasickReplacer:
+    def __init__(self, replacement_rules):
+        """
+        基于 Aho-Corasick 自动机的多模式替换器，构建一次后对任意文本做单次线性扫描。
+
+        匹配采用最左最长语义：从左到右扫描，同一起点取最长的规则，替换后的文本不会被再次匹配。
+
+        参数:
+        replacement_rules (list): 替换规则列表，每个规则是 (old, new) 元组，同一 old 以第一条为准。
+        """
+        self.replacements = {}
+        for old, new in replacement_rules:
+            if old and old not in self.replacements:
+                self.replacements[old] = new
+        self._build()
+
+    def _build(self):
+        # goto: 每个状态的转移表；length: 以该状态结尾的规则长度(0 表示不是规则结尾)
+        # output_link: 沿失败链最近的规则结尾状态，用于枚举在同一位置结束的所有规则
+        self.goto = [{}]
+        self.length = [0]
+        for old in self.replacements:
+            state = 0
+            for char in old:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.length.append(0)
+                state = next_state
+            self.length[state] = len(old)
+
+        self.fail = [0] * len(self.goto)
+        self.output_link = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output_link[next_state] = fail if self.length[fail] else self.output_link[fail]
+                queue.append(next_state)
+
+    def replace(self, text):
+        """
+        替换文本中的所有规则。
+
+        参数:
+        text (str): 输入文本。
+
+        返回:
+        str: 替换后的文本。
+        """
+        if not self.replacements:
+            return text
+
+        # 第一遍：记录每个起点能匹配到的最长规则长度
+        longest = [0] * len(text)
+        found = False
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            match = state if self.length[state] else self.output_link[state]
+            while match:
+                start = end - self.length[match]
+                if self.length[match] > longest[start]:
+                    longest[start] = self.length[match]
+                    found = True
+                match = self.output_link[match]
+        if not found:
+            return text
+
+        # 第二遍：从左到右贪心选取不重叠的匹配
+        pieces = []
+        position = 0
+        for start, length in enumerate(longest):
+            if not length or start < position:
+                continue
+            end = start + length
+            pieces.append(text[position:start])
+            pieces.append(self.replacements[text[start:end]])
+            position = end
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+
+_replacer_cache = {}
+_replacer_lock = threading.Lock()
+
+
+def get_text_replacer(replacement_file):
+    """
+    返回编译好的替换器。按文件路径缓存，文件修改时间或大小变化时重新编译。
+
+    参数:
+    replacement_file (str): 替换规则文件路径。
+
+    返回:
+    AhoCorasickReplacer: 替换器。
+    """
+    stat = os.stat(replacement_file)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _replacer_lock:
+        cached = _replacer_cache.get(replacement_file)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        replacer = AhoCorasickReplacer(TextReplacer.load_replacement_rules_from_txt(replacement_file))
+        _replacer_cache[replacement_file] = (signature, replacer)
+        return replacer
 
 
 class TextReplacer:
@@ -10,10 +130,12 @@ class TextReplacer:
         replacement_file (str): 替换规则文件路径。
         """
         self.input_string = input_string
-        self.replacement_rules = self.load_replacement_rules_from_txt(replacement_file) if replacement_file else []
+        self.replacer = get_text_replacer(replacement_file) if replacement_file else AhoCorasickReplacer([])
+        self.replacement_rules = list(self.replacer.replacements.items())
         self.result_string = self.replace_phrases()
 
-    def load_replacement_rules_from_txt(self, file_path):
+    @staticmethod
+    def load_replacement_rules_from_txt(file_path):
         """
         从 .txt 文件中加载替换规则。
 
@@ -33,12 +155,9 @@ class TextReplacer:
 
     def replace_phrases(self):
         """
-        根据替换规则列表替换字符串中的短语。
+        根据替换规则替换字符串中的短语，单次扫描完成所有规则。
 
         返回:
         str: 替换后的字符串。
         """
-        result = self.input_string
-        for old, new in self.replacement_rules:
-            result = result.replace(old, new)
-        return result
+        return self.replacer.replace(self.input_string)
@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+
+
+def _best_offset(region, target, decimation):
+    """
+    在 region 中搜索与 target 互相关最大的起始偏移。先在降采样信号上粗搜，再在原始信号上细搜。
+
+    参数:
+    region (numpy.ndarray): 搜索区域，长度为 len(target) + 搜索范围。
+    target (numpy.ndarray): 匹配模板。
+    decimation (int): 粗搜的降采样倍数。
+
+    返回:
+    int: 最佳偏移。
+    """
+    max_offset = len(region) - len(target)
+    if decimation > 1:
+        coarse = np.correlate(region[::decimation], target[::decimation], mode='valid')
+        center = int(np.argmax(coarse)) * decimation
+        lo, hi = max(center - decimation + 1, 0), min(center + decimation - 1, max_offset)
+    else:
+        lo, hi = 0, max_offset
+    fine = np.correlate(region[lo:hi + len(target)], target, mode='valid')
+    return lo + int(np.argmax(fine))
+
+
+def wsola(samples, speed, frame_length=1024, search_length=256, decimation=4):
+    """
+    WSOLA(波形相似叠加)变速不变调。
+
+    参数:
+    samples (numpy.ndarray): 单声道 float32 音频。
+    speed (float): 播放速度，大于 1.0 加快，小于 1.0 减慢。
+    frame_length (int): 帧长，合成帧移为帧长的一半。
+    search_length (int): 每帧在名义位置两侧的搜索范围(采样点)。
+    decimation (int): 粗搜的降采样倍数，1 表示不降采样。
+
+    返回:
+    numpy.ndarray: 处理后的 float32 音频，长度约为 len(samples) / speed。
+    """
+    hop_s = frame_length // 2
+    hop_a = hop_s * speed
+    n_out = int(round(len(samples) / speed))
+    # 左侧补半帧静音，使第一帧的淡入落在静音上，输出再按对应长度裁掉
+    trim = int(round(hop_s / speed))
+    n_frames = (trim + n_out) // hop_s + 2
+    pad_left = search_length + hop_s
+    pad_right = int(np.ceil(n_frames * hop_a)) + search_length + frame_length
+    x = np.zeros(pad_left + len(samples) + pad_right, dtype=np.float32)
+    x[pad_left:pad_left + len(samples)] = samples
+
+    # 周期 Hann 窗在 50% 重叠时叠加恒为 1
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_length) / frame_length)).astype(np.float32)
+    out = np.zeros(n_frames * hop_s + frame_length, dtype=np.float32)
+    overlap = frame_length - hop_s
+    prev = None
+    for k in range(n_frames):
+        nominal = search_length + int(round(k * hop_a))
+        if prev is None:
+            pos = nominal
+        else:
+            # 与上一帧的自然延续最相似的位置
+            target = x[prev + hop_s:prev + frame_length]
+            lo = nominal - search_length
+            region = x[lo:nominal + search_length + overlap]
+            pos = lo + _best_offset(region, target, decimation)
+        out[k * hop_s:k * hop_s + frame_length] += x[pos:pos + frame_length] * window
+        prev = pos
+    return out[trim:trim + n_out]
+
+
+def time_stretch(speech, speed, **kwargs):
+    """
+    对 float32 音频张量变速不变调，进程内完成，不再调用 ffmpeg。
+
+    参数:
+    speech (torch.Tensor): 音频，形状 (channels, samples) 或 (samples,)。
+    speed (float): 播放速度，大于 1.0 加快，小于 1.0 减慢。
+    **kwargs: 传给 wsola 的参数。
+
+    返回:
+    torch.Tensor: 处理后的 float32 音频，形状与输入维度一致。
+    """
+    if speed <= 0:
+        raise ValueError("播放速度必须大于 0")
+    if speed == 1.0:
+        return speech
+    array = speech.detach().cpu().float().numpy()
+    if array.ndim == 1:
+        return torch.from_numpy(wsola(array, speed, **kwargs))
+    return torch.from_numpy(np.stack([wsola(channel, speed, **kwargs) for channel in array]))
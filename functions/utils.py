@@ -1,6 +1,7 @@
 
 import os
 import glob
+import json
 from cosyvoice.cli.cosyvoice import CosyVoice
 from cosyvoice.utils.file_utils import logging
 from tqdm import tqdm
@@ -12,7 +13,9 @@ import ffmpeg
 import folder_paths
 from time import time as ttime
 
-from functions.text_replacer import TextReplacer
+from functions.text_replacer import get_text_replacer
+from functions.time_stretch import time_stretch
+from functions.audio_assembler import AudioAssembler
 import config
 
 def get_device():
@@ -60,26 +63,31 @@ def generate_audio(output, t0, speed, target_sr=config.AUDIO_TARGET_SAMPLE_RATE)
     返回:
     dict: 包含生成的波形数据和采样率的字典。
     """
-    output_list = []
+    assembler = AudioAssembler(target_sr)
+    # 只有 ffmpeg 变速需要 16-bit PCM，其余情况全程保持 float32
+    use_ffmpeg = config.SPEED_CHANGE_BACKEND == "ffmpeg" and speed != 1.0
     
     for out_dict in output:
-        # 将 'tts_speech' 数据从张量转换为 NumPy 数组，并放大到 16-bit PCM 范围
-        output_numpy = out_dict['tts_speech'].squeeze(0).numpy() * 32768
-        output_numpy = output_numpy.astype(np.int16)
-        
-        # 如果播放速度不为1.0，则调整音频速度
-        if speed > 1.0 or speed < 1.0:
+        speech = out_dict['tts_speech']
+        if use_ffmpeg:
+            # 放大到 16-bit PCM 范围后逐块调用 ffmpeg 变速，再标准化回原范围
+            output_numpy = (speech.squeeze(0).numpy() * 32768).astype(np.int16)
             output_numpy = speed_change(output_numpy, speed, target_sr)
-        
-        # 将 NumPy 数组转换回张量，并标准化回原范围
-        output_list.append(torch.Tensor(output_numpy / 32768).unsqueeze(0))
+            speech = torch.from_numpy(output_numpy.astype(np.float32) / 32768).unsqueeze(0)
+        # 直接写入预分配的缓冲区
+        assembler.append(speech)
     
+    waveform = assembler.waveform()
+    if not use_ffmpeg and speed != 1.0:
+        # 拼接后一次性变速，避免逐块处理造成的接缝
+        waveform = time_stretch(waveform, speed)
+
     # 计算音频生成的耗时
     t1 = ttime()
     print("cost time \t %.3f" % (t1 - t0))
     
     # 返回生成的波形数据和采样率
-    return {"waveform": torch.cat(output_list, dim=1).unsqueeze(0), "sample_rate": target_sr}
+    return {"waveform": waveform.unsqueeze(0), "sample_rate": target_sr}
 
 def postprocess(speech, top_db=60, hop_length=220, win_length=440, max_val=0.8, target_sr=config.AUDIO_TARGET_SAMPLE_RATE):
     """
@@ -116,7 +124,7 @@ def postprocess(speech, top_db=60, hop_length=220, win_length=440, max_val=0.8,
 
 def speed_change(input_audio, speed, sr):
     """
-    调整音频的播放速度。
+    调整音频的播放速度(ffmpeg atempo)，仅在 SPEED_CHANGE_BACKEND 为 "ffmpeg" 时使用。
 
     参数:
     input_audio (numpy.ndarray): 输入的音频数据，必须是 np.int16 类型。
@@ -179,6 +187,37 @@ def list_model_files(directory, extension=".pt"):
 
 def replace_tts_text(tts_text, file_name="多音字纠正配置.txt"):
     replacement_file= os.path.join(config.COSYVOICE_NODE_DIR, file_name)
-    replacer = TextReplacer(tts_text, replacement_file)
-    result_string = replacer.result_string
-    return result_string
\ No newline at end of file
+    # 规则文件编译后缓存，文件修改后自动重新编译
+    return get_text_replacer(replacement_file).replace(tts_text)
+
+
+def parse_batch_text(batch_text, default_speaker):
+    """
+    解析批量合成文本。支持 JSON 列表或每行一条两种格式。
+
+    JSON 列表的元素可以是字符串，或包含 "text" 和可选 "speaker" 的对象；
+    按行书写时，每行为 "文本" 或 "说话人|文本"，空行会被忽略。
+
+    参数:
+    batch_text (str): 批量文本。
+    default_speaker (str): 未指定说话人时使用的说话人。
+
+    返回:
+    list: (文本, 说话人) 元组列表。
+    """
+    batch_text = batch_text.strip()
+    items = []
+    if batch_text.startswith('['):
+        for item in json.loads(batch_text):
+            if isinstance(item, str):
+                items.append((item, default_speaker))
+            else:
+                items.append((item['text'], item.get('speaker') or default_speaker))
+    else:
+        for line in batch_text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            speaker, sep, text = line.partition('|')
+            items.append((text.strip(), speaker.strip() or default_speaker) if sep else (line, default_speaker))
+    return items
@@ -1,6 +1,4 @@
-import os
 import torch
-import torchaudio
 import numpy as np
 import ffmpeg
 import folder_paths
@@ -10,11 +8,12 @@ import config
 from time import time as ttime
 
 from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.resample import resample
 
 from functions.download_models import download_cosyvoice_300m
-from functions.cosyvoice_patches import CosyVoicePatches as CosyVoice
-from functions.utils import postprocess, get_device, generate_audio, get_speaker_folders, list_model_files, replace_tts_text
-from functions.text_replacer import TextReplacer
+from functions.model_registry import load_cosyvoice, model_registry
+from functions.utils import postprocess, get_device, generate_audio, replace_tts_text, parse_batch_text
+from functions.speaker_library import get_speaker_library
 
 # NCE 预训练音色
 class NCECosyVoiceSFT:
@@ -43,6 +42,9 @@ class NCECosyVoiceSFT:
             },
             "optional":{
                 "tts_text":("STRING",),
+                "quality":(list(config.FLOW_QUALITY_PRESETS),{
+                    "default": "标准"
+                }),
             }
         }
     
@@ -50,7 +52,7 @@ class NCECosyVoiceSFT:
     RETURN_TYPES = ("AUDIO",)
     FUNCTION="generate"
 
-    def generate(self, tts_text, speed, speaker, seed, use_25hz, stream, polyreplace=False):
+    def generate(self, tts_text, speed, speaker, seed, use_25hz, stream, polyreplace=False, quality="标准"):
         t0 = ttime()
         _, model_dir = download_cosyvoice_300m(use_25hz)
 
@@ -60,12 +62,13 @@ class NCECosyVoiceSFT:
             print("You have enabled polyphonic word replacement.")
             tts_text = replace_tts_text(tts_text)
             
-        cosyvoice = CosyVoice(model_dir)
-        set_all_random_seed(seed)
+        with load_cosyvoice(model_dir) as cosyvoice:
+            set_all_random_seed(seed)
 
-        print('get inference_sft inference request')
-        output = cosyvoice.inference_sft(tts_text=tts_text, spk_id=speaker, stream=stream)
-        audio= generate_audio(output,t0,speed)
+            print('get inference_sft inference request')
+            output = cosyvoice.inference_sft(tts_text=tts_text, spk_id=speaker, stream=stream,
+                                             flow_options=config.FLOW_QUALITY_PRESETS[quality])
+            audio= generate_audio(output,t0,speed)
 
         return (audio,)
 
@@ -88,6 +91,9 @@ class NCECosyVoiceCrossLingual:
             },
             "optional":{
                 "tts_text":("STRING",),
+                "quality":(list(config.FLOW_QUALITY_PRESETS),{
+                    "default": "标准"
+                }),
             }
         }
     
@@ -95,7 +101,7 @@ class NCECosyVoiceCrossLingual:
     RETURN_TYPES = ("AUDIO",)
     FUNCTION="generate"
 
-    def generate(self, tts_text, prompt_wav, speed, seed, use_25hz, polyreplace=False):
+    def generate(self, tts_text, prompt_wav, speed, seed, use_25hz, polyreplace=False, quality="标准"):
         t0 = ttime()
         _, model_dir = download_cosyvoice_300m(use_25hz)
 
@@ -111,15 +117,16 @@ class NCECosyVoiceCrossLingual:
         source_sr = prompt_wav['sample_rate']
         speech = waveform.mean(dim=0,keepdim=True)
         if source_sr != config.AUDIO_PROMPT_SAMPLE_RATE:
-            speech = torchaudio.transforms.Resample(orig_freq=source_sr, new_freq=config.AUDIO_PROMPT_SAMPLE_RATE)(speech)
+            speech = resample(speech, source_sr, config.AUDIO_PROMPT_SAMPLE_RATE)
 
         print('get inference_cross_lingual inference request')
         prompt_speech_16k = postprocess(speech)
         set_all_random_seed(seed)
 
-        cosyvoice = CosyVoice(model_dir)
-        output = cosyvoice.inference_cross_lingual(tts_text=tts_text, prompt_speech_16k=prompt_speech_16k, stream=False, speed=speed)
-        audio= generate_audio(output,t0,speed)
+        with load_cosyvoice(model_dir) as cosyvoice:
+            output = cosyvoice.inference_cross_lingual(tts_text=tts_text, prompt_speech_16k=prompt_speech_16k, stream=False, speed=speed,
+                                                       flow_options=config.FLOW_QUALITY_PRESETS[quality])
+            audio= generate_audio(output,t0,speed)
         
         return (audio,)
 
@@ -154,6 +161,9 @@ class NCECosyVoiceZeroShot:
                 "prompt_text":("STRING",),
                 "prompt_wav": ("AUDIO",),
                 "speaker_model":("SPEAKER_MODEL",),
+                "quality":(list(config.FLOW_QUALITY_PRESETS),{
+                    "default": "标准"
+                }),
             }
         }
     
@@ -162,7 +172,7 @@ class NCECosyVoiceZeroShot:
     RETURN_TYPES = ("AUDIO", "SPEAKER_MODEL", )
     FUNCTION="generate"
 
-    def generate(self, tts_text, speed, seed, stream, use_25hz, prompt_text=None, prompt_wav=None, speaker_model=None, polyreplace=False):
+    def generate(self, tts_text, speed, seed, stream, use_25hz, prompt_text=None, prompt_wav=None, speaker_model=None, polyreplace=False, quality="标准"):
         t0 = ttime()
         _, model_dir = download_cosyvoice_300m(use_25hz)
 
@@ -172,39 +182,114 @@ class NCECosyVoiceZeroShot:
             print("You have enabled polyphonic word replacement.")
             tts_text = replace_tts_text(tts_text)
 
-        cosyvoice = CosyVoice(model_dir)
+        flow_options = config.FLOW_QUALITY_PRESETS[quality]
         __spk_model = None        
 
-        if speaker_model is None:
-            assert len(prompt_text) > 0, "参考音频文本(prompt)不能为空"
-            assert prompt_wav is not None, " 参考音频(prompt_wav)不能为空"
+        with load_cosyvoice(model_dir) as cosyvoice:
+            if speaker_model is None:
+                assert len(prompt_text) > 0, "参考音频文本(prompt)不能为空"
+                assert prompt_wav is not None, " 参考音频(prompt_wav)不能为空"
 
-            waveform = prompt_wav['waveform'].squeeze(0)
-            source_sr = prompt_wav['sample_rate']
-            speech = waveform.mean(dim=0,keepdim=True)
-            if source_sr != config.AUDIO_PROMPT_SAMPLE_RATE:
-                speech = torchaudio.transforms.Resample(orig_freq=source_sr, new_freq=config.AUDIO_PROMPT_SAMPLE_RATE)(speech)
+                waveform = prompt_wav['waveform'].squeeze(0)
+                source_sr = prompt_wav['sample_rate']
+                speech = waveform.mean(dim=0,keepdim=True)
+                if source_sr != config.AUDIO_PROMPT_SAMPLE_RATE:
+                    speech = resample(speech, source_sr, config.AUDIO_PROMPT_SAMPLE_RATE)
 
-            print('get zero_shot inference request')
-            prompt_speech_16k = postprocess(speech)
-            set_all_random_seed(seed)
+                print('get zero_shot inference request')
+                prompt_speech_16k = postprocess(speech)
+                set_all_random_seed(seed)
 
-            output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, stream, speed)
-            audio= generate_audio(output,t0,speed)
-            __spk_model = cosyvoice.frontend.frontend_zero_shot(tts_text, prompt_text, prompt_speech_16k, config.AUDIO_TARGET_SAMPLE_RATE)
-            del __spk_model['text']
-            del __spk_model['text_len']
+                output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, stream, speed, flow_options=flow_options)
+                audio= generate_audio(output,t0,speed)
+                __spk_model = cosyvoice.frontend_speaker_model(prompt_text, prompt_speech_16k)
 
-        else:
-            print('get zero_shot_with_speaker_model inference request')
-            set_all_random_seed(seed)
-            output = cosyvoice.inference_sft_with_speaker_model(tts_text, speaker_model, stream, speed)
-            audio= generate_audio(output,t0,speed)
+            else:
+                print('get zero_shot_with_speaker_model inference request')
+                set_all_random_seed(seed)
+                output = cosyvoice.inference_zero_shot_from_bundle(tts_text, speaker_model, stream, speed, flow_options=flow_options)
+                audio= generate_audio(output,t0,speed)
 
-            __spk_model = speaker_model
+                __spk_model = speaker_model
         return (audio, __spk_model, )
 
 
+# NCE 批量合成
+class NCECosyVoiceBatch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required":{
+                "batch_text":("STRING", {
+                    "default": "",
+                    "multiline": True
+                }),
+                "speaker":(config.SFT_SPEAKER_LIST,{
+                    "default":"中文女"
+                }),
+                "speed":("FLOAT",{
+                    "default": 1.0
+                }),
+                "seed":("INT",{
+                    "default": 42
+                }),
+                "batch_size":("INT",{
+                    "default": 8,
+                    "min": 1,
+                    "max": 64
+                }),
+                "use_25hz":("BOOLEAN",{
+                    "default": False
+                }),
+                "polyreplace":("BOOLEAN",{
+                    "default": False
+                }),
+            },
+            "optional":{
+                "speaker_model":("SPEAKER_MODEL",),
+                "quality":(list(config.FLOW_QUALITY_PRESETS),{
+                    "default": "标准"
+                }),
+            }
+        }
+
+    CATEGORY = config.CATEGORY_NAME
+    RETURN_TYPES = ("AUDIO",)
+    OUTPUT_IS_LIST = (True,)
+    FUNCTION="generate"
+
+    def generate(self, batch_text, speaker, speed, seed, batch_size, use_25hz, polyreplace=False, speaker_model=None, quality="标准"):
+        t0 = ttime()
+        _, model_dir = download_cosyvoice_300m(use_25hz)
+
+        # 每行一条(可写作 "说话人|文本")或 JSON 列表，未指定说话人时使用 speaker_model 或预训练音色
+        items = parse_batch_text(batch_text, None)
+        assert len(items) > 0, "文本(batch_text)不能为空"
+        speaker_library = get_speaker_library()
+        requests = []
+        for tts_text, name in items:
+            assert len(tts_text) > 0, "文本(batch_text)中存在空文本"
+            if polyreplace:
+                tts_text = replace_tts_text(tts_text)
+            if name is None:
+                spk = speaker_model if speaker_model is not None else speaker
+            elif name in config.SFT_SPEAKER_LIST:
+                spk = name
+            else:
+                assert name in speaker_library, f"说话人 {name} 不存在"
+                spk = speaker_library.get(name, get_device())
+            requests.append((tts_text, spk))
+
+        with load_cosyvoice(model_dir) as cosyvoice:
+            set_all_random_seed(seed)
+
+            print(f'get inference_batch inference request, {len(requests)} items')
+            outputs = cosyvoice.inference_batch(requests, batch_size=batch_size, flow_options=config.FLOW_QUALITY_PRESETS[quality])
+            audios = [generate_audio(output, t0, speed) for output in outputs]
+
+        return (audios,)
+
+
 # NCE 保存说话人模型
 class NCECosyVoiceSaveSpeakerModel:
     @classmethod
@@ -224,27 +309,23 @@ class NCECosyVoiceSaveSpeakerModel:
     FUNCTION="generate"
 
     def generate(self, spk_model, speaker_name):
-        speaker_model_dir = get_speaker_folders()
+        assert len(speaker_name) > 0, "说话人名称(speaker_name)不能为空"
+        speaker_library = get_speaker_library()
 
-        # 判断目录是否存在，不存在则创建
-        print(f"saving speaker model {speaker_name} to {speaker_model_dir}")
-        if not os.path.exists(speaker_model_dir):
-            os.makedirs(speaker_model_dir)
-        
-        # 保存模型
-        speaker_full_name= speaker_name + ".pt"
-        torch.save(spk_model, os.path.join(speaker_model_dir, speaker_full_name))
-        return speaker_full_name
+        # 保存到说话人库，统一转换为当前版本的提示包
+        print(f"saving speaker model {speaker_name} to {speaker_library.root}")
+        speaker_library.add(speaker_name, spk_model)
+        return ()
 
 # NCE 加载说话人模型
 class NCECosyVoiceLoadSpeakerModel:
     @classmethod
     def INPUT_TYPES(s):
-        speaker_models = list_model_files(get_speaker_folders())
+        speaker_models = get_speaker_library().names()
         return {
             "required":{
                 "speaker_model":(speaker_models,{
-                    "default": speaker_models[0]
+                    "default": speaker_models[0] if speaker_models else ""
                 }),
             }
         }
@@ -256,10 +337,40 @@ class NCECosyVoiceLoadSpeakerModel:
 
     def generate(self, speaker_model):
         # print(f"loading speaker model {speaker_model}")
-        full_speaker_model_path = os.path.join(get_speaker_folders(), speaker_model + ".pt")
-        assert os.path.exists(full_speaker_model_path), "Speaker model is not exist"
+        speaker_library = get_speaker_library()
+        assert speaker_model in speaker_library, "Speaker model is not exist"
 
-        SPEAKER_MODEL = torch.load(full_speaker_model_path, map_location= get_device())
+        SPEAKER_MODEL = speaker_library.get(speaker_model, get_device())
 
         return (SPEAKER_MODEL, )
 
+
+
+# NCE 卸载 CosyVoice 模型
+class NCECosyVoiceUnloadModels:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required":{
+                "unload_all":("BOOLEAN",{
+                    "default": True
+                }),
+                "use_25hz":("BOOLEAN",{
+                    "default": False
+                }),
+            }
+        }
+
+    CATEGORY = config.CATEGORY_NAME
+    RETURN_TYPES = ()
+    OUTPUT_NODE = True
+    FUNCTION="generate"
+
+    def generate(self, unload_all, use_25hz):
+        if unload_all:
+            count = model_registry.unload_all()
+        else:
+            _, model_dir = download_cosyvoice_300m(use_25hz)
+            count = int(model_registry.unload(model_dir))
+        print(f"unloaded {count} cosyvoice model(s)")
+        return ()
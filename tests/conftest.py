@@ -0,0 +1,77 @@
+# Tests run from the plugin directory: python -m pytest tests
+# Small stand-ins for llm / flow / hift, so model.py can be exercised without model files.
+import os
+import sys
+
+import pytest
+import torch
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+sys.path.append(os.path.join(node_root, 'third_party', 'matcha_tts'))
+
+
+class FakeLLM(torch.nn.Module):
+    """Yields n_tokens speech tokens per request, like TransformerLM.inference."""
+
+    def __init__(self, n_tokens=300):
+        super().__init__()
+        self.n_tokens = n_tokens
+
+    @torch.inference_mode()
+    def inference(self, text, **kwargs):
+        for i in range(self.n_tokens):
+            yield (int(text[0, 0]) + i) % 100
+
+
+class FakeFlow(torch.nn.Module):
+    """Two mel frames per token, created under inference mode like MaskedDiffWithXvec.inference."""
+    input_frame_rate = 50
+    token_mel_ratio = 2
+    pre_lookahead_len = 3
+
+    def __init__(self):
+        super().__init__()
+        self.encoder = torch.nn.Module()
+        self.decoder = torch.nn.Module()
+        self.decoder.estimator = torch.nn.Module()
+
+    @torch.inference_mode()
+    def inference(self, token, flow_cache=None, **kwargs):
+        mel = token.float().repeat_interleave(self.token_mel_ratio, dim=1).unsqueeze(dim=1).repeat(1, 80, 1) / 100
+        return mel, flow_cache
+
+
+class FakeHift(torch.nn.Module):
+    """hop_len samples per mel frame, created under inference mode like HiFTGenerator.inference."""
+
+    def __init__(self, hop_len=256):
+        super().__init__()
+        self.hop_len = hop_len
+
+    @torch.inference_mode()
+    def inference(self, speech_feat, cache_source=torch.zeros(1, 1, 0)):
+        tts_speech = speech_feat.mean(dim=1).repeat_interleave(self.hop_len, dim=1)
+        return tts_speech, tts_speech.unsqueeze(dim=1)
+
+
+def model_input(text_id=1):
+    return {'text': torch.tensor([[text_id]], dtype=torch.int32),
+            'flow_embedding': torch.zeros(1, 192),
+            'llm_embedding': torch.zeros(1, 192)}
+
+
+@pytest.fixture
+def cosyvoice_model():
+    from cosyvoice.cli.model import CosyVoiceModel
+    model = CosyVoiceModel(FakeLLM(), FakeFlow(), FakeHift(256), False)
+    model.device = torch.device('cpu')
+    return model
+
+
+@pytest.fixture
+def cosyvoice2_model():
+    from cosyvoice.cli.model import CosyVoice2Model
+    model = CosyVoice2Model(FakeLLM(), FakeFlow(), FakeHift(480))
+    model.device = torch.device('cpu')
+    return model
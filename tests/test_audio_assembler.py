@@ -0,0 +1,31 @@
+import torch
+
+from functions.audio_assembler import AudioAssembler
+
+
+def test_append_and_grow():
+    assembler = AudioAssembler(100, channels=2, initial_seconds=0.05)
+    chunks = [torch.randn(2, n) for n in (3, 1, 20, 7)]
+    for chunk in chunks:
+        assembler.append(chunk)
+    assert torch.equal(assembler.waveform(), torch.concat(chunks, dim=1))
+    assert assembler.duration() == 0.31
+
+
+def test_waveform_owns_its_samples():
+    assembler = AudioAssembler(100)
+    assembler.append(torch.ones(1, 10))
+    waveform = assembler.waveform()
+    # trimmed to the written samples, not a view into the preallocated buffer
+    assert waveform.untyped_storage().nbytes() == 10 * waveform.element_size()
+    assert assembler.waveform() is waveform
+    assembler.append(torch.zeros(1, 5))
+    assert torch.equal(waveform, torch.ones(1, 10))
+    assert torch.equal(assembler.waveform(), torch.concat([torch.ones(1, 10), torch.zeros(1, 5)], dim=1))
+
+
+def test_empty_waveform_then_append():
+    assembler = AudioAssembler(100)
+    assert assembler.waveform().shape == (1, 0)
+    assembler.append(torch.ones(1, 4))
+    assert torch.equal(assembler.waveform(), torch.ones(1, 4))
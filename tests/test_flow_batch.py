@@ -0,0 +1,75 @@
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+omegaconf = pytest.importorskip('omegaconf')
+pytest.importorskip('matcha.models.components.decoder')
+pytest.importorskip('matcha.models.components.transformer')
+
+from cosyvoice.flow.decoder import ConditionalDecoder  # noqa: E402
+from cosyvoice.flow.flow import MaskedDiffWithXvec  # noqa: E402
+from cosyvoice.flow.flow_matching import ConditionalCFM  # noqa: E402
+from cosyvoice.flow.length_regulator import InterpolateRegulator  # noqa: E402
+from cosyvoice.transformer.encoder import ConformerEncoder  # noqa: E402
+
+
+@pytest.fixture
+def flow():
+    torch.manual_seed(0)
+    encoder = ConformerEncoder(64, output_size=64, attention_heads=4, linear_units=128, num_blocks=2, input_layer='linear',
+                               pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                               use_cnn_module=False, macaron_style=False)
+    length_regulator = InterpolateRegulator(80, sampling_ratios=[1, 1], out_channels=80)
+    cfm_params = omegaconf.DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine',
+                                       'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    estimator = ConditionalDecoder(320, 80, channels=[64], n_blocks=1, num_mid_blocks=1, num_heads=2, attention_head_dim=32)
+    estimator.static_chunk_size = 0
+    decoder = ConditionalCFM(320, cfm_params, estimator=estimator)
+    return MaskedDiffWithXvec(input_size=64, output_size=80, vocab_size=100, encoder=encoder,
+                              length_regulator=length_regulator, decoder=decoder).eval()
+
+
+def make_item(token_len, prompt_token_len, prompt_feat_len):
+    return (torch.randint(0, 100, (1, token_len)), torch.randint(0, 100, (1, prompt_token_len)),
+            torch.randn(1, prompt_feat_len, 80), torch.randn(1, 192))
+
+
+def single(flow, item, **kwargs):
+    token, prompt_token, prompt_feat, embedding = item
+    tts_mel, _ = flow.inference(token, torch.tensor([token.shape[1]]), prompt_token, torch.tensor([prompt_token.shape[1]]),
+                                prompt_feat, torch.tensor([prompt_feat.shape[1]]), embedding, torch.zeros(1, 80, 0, 2), **kwargs)
+    return tts_mel
+
+
+def batch(flow, items, **kwargs):
+    def pad(tensors):
+        return pad_sequence([t[0] for t in tensors], batch_first=True), torch.tensor([t.shape[1] for t in tensors])
+    token, token_len = pad([i[0] for i in items])
+    prompt_token, prompt_token_len = pad([i[1] for i in items])
+    prompt_feat, prompt_feat_len = pad([i[2] for i in items])
+    return flow.inference_batch(token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len,
+                                torch.concat([i[3] for i in items]), **kwargs)
+
+
+@pytest.mark.parametrize('flow_options', [{}, {'solver': 'heun', 'n_timesteps': 3}])
+def test_inference_batch_of_one_is_bit_identical(flow, flow_options):
+    # unpadded batches keep the plain nn.GroupNorm blocks of the decoder
+    assert isinstance(flow.decoder.estimator.final_block.block[1], torch.nn.GroupNorm)
+    item = make_item(30, 10, 20)
+    torch.manual_seed(1)
+    expected = single(flow, item, **flow_options)
+    torch.manual_seed(1)
+    tts_mel, = batch(flow, [item], **flow_options)
+    assert torch.equal(tts_mel, expected)
+
+
+@pytest.mark.parametrize('flow_options', [{}, {'solver': 'heun', 'n_timesteps': 3}, {'cfg_interval': (0.0, 0.5)}])
+def test_inference_batch_mixed_lengths(flow, flow_options):
+    items = [make_item(30, 10, 20), make_item(50, 0, 0), make_item(12, 25, 40), make_item(30, 10, 20)]
+    seeds = [11, 12, 13, 14]
+    tts_mels = batch(flow, items, seeds=seeds, **flow_options)
+    for tts_mel, item, seed in zip(tts_mels, items, seeds):
+        torch.manual_seed(seed)
+        expected = single(flow, item, **flow_options)
+        assert tts_mel.shape == expected.shape
+        assert torch.allclose(tts_mel, expected, atol=1e-4)
@@ -0,0 +1,75 @@
+import math
+
+import pytest
+import torch
+
+omegaconf = pytest.importorskip('omegaconf')
+pytest.importorskip('onnxruntime')
+pytest.importorskip('matcha.models.components.flow_matching')
+
+from cosyvoice.flow.flow_matching import ConditionalCFM  # noqa: E402
+
+
+class LinearEstimator(torch.nn.Module):
+    """dx/dt = 2 * t * mu - x, x(1) = (x(0) + 2 * mu) / e, (x(0) + 2 * (1 + cfg_rate) * mu) / e with guidance."""
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None):
+        return (2 * t.view(-1, 1, 1) * mu - x) * mask
+
+
+def make_cfm(inference_cfg_rate=0.7, estimator=None):
+    cfm_params = omegaconf.DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine',
+                                       'training_cfg_rate': 0.2, 'inference_cfg_rate': inference_cfg_rate, 'reg_loss_type': 'l1'})
+    return ConditionalCFM(80, cfm_params, estimator=LinearEstimator() if estimator is None else estimator)
+
+
+def solve(cfm, n_timesteps, solver):
+    torch.manual_seed(0)
+    mu = torch.randn(2, 80, 40)
+    x0 = torch.randn(2, 80, 40)
+    t_span = 1 - torch.cos(torch.linspace(0, 1, n_timesteps + 1) * 0.5 * torch.pi)
+    x1 = cfm.solve(x0.clone(), t_span, mu, torch.ones(2, 1, 40), torch.zeros(2, 80), torch.zeros(2, 80, 40), solver=solver)
+    return x1, (x0 + 2 * (1 + cfm.inference_cfg_rate) * mu) / math.e
+
+
+@pytest.mark.parametrize('solver', list(ConditionalCFM.solvers))
+def test_solver_converges_to_euler_solution(solver):
+    cfm = make_cfm()
+    x1, exact = solve(cfm, 200, solver)
+    euler_x1, _ = solve(cfm, 2000, 'euler')
+    assert torch.allclose(euler_x1, exact, atol=1e-2)
+    assert torch.allclose(x1, euler_x1, atol=2e-2)
+    if solver != 'euler':
+        # second order, closer to the exact solution than euler at the same step count
+        x1, _ = solve(cfm, 10, solver)
+        euler_x1, _ = solve(cfm, 10, 'euler')
+        assert (x1 - exact).abs().max() < 0.5 * (euler_x1 - exact).abs().max()
+
+
+def test_unknown_solver():
+    with pytest.raises(ValueError):
+        solve(make_cfm(), 10, 'rk4')
+
+
+def test_cfg_schedule_bounds():
+    cfm = make_cfm()
+    assert cfm.cfg_schedule(10) == [True] * 10
+    assert cfm.cfg_schedule(10, (0.0, 0.5)) == [True] * 5 + [False] * 5
+    assert cfm.cfg_schedule(10, (0.2, 0.6)) == [False] * 2 + [True] * 4 + [False] * 4
+    assert cfm.cfg_schedule(4, (0.5, 1.0)) == [False, False, True, True]
+    assert cfm.cfg_schedule(10, (0.0, 0.0)) == [False] * 10
+    assert cfm.cfg_schedule(1, (0.0, 0.5)) == [True]
+    cfm.cfg_interval = (0.5, 1.0)
+    assert cfm.cfg_schedule(2) == [False, True]
+    # no guidance without cfg rate, always guided for trt engines built for the guided batch
+    assert make_cfm(inference_cfg_rate=0).cfg_schedule(10, (0.0, 0.5)) == [False] * 10
+    assert make_cfm(estimator=object()).cfg_schedule(10, (0.0, 0.5)) == [True] * 10
+
+
+def test_unguided_steps_use_the_conditioned_velocity():
+    cfm = make_cfm()
+    t_span = torch.linspace(0, 1, 11)
+    mu, x0 = torch.randn(1, 80, 20), torch.randn(1, 80, 20)
+    x1 = cfm.solve(x0.clone(), t_span, mu, torch.ones(1, 1, 20), torch.zeros(1, 80), torch.zeros(1, 80, 20), cfg_interval=(0.0, 0.0))
+    expected = make_cfm(inference_cfg_rate=0).solve(x0.clone(), t_span, mu, torch.ones(1, 1, 20), torch.zeros(1, 80), torch.zeros(1, 80, 20))
+    assert torch.allclose(x1, expected)
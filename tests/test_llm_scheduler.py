@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from conftest import FakeFlow, FakeHift
+
+pytest.importorskip('transformers')
+cosyvoice_cli = pytest.importorskip('cosyvoice.cli.cosyvoice')
+
+from cosyvoice.cli.model import CosyVoiceModel  # noqa: E402
+from cosyvoice.llm.llm import TransformerLM  # noqa: E402
+from cosyvoice.transformer.encoder import ConformerEncoder, TransformerEncoder  # noqa: E402
+
+SPEECH_TOKEN_SIZE = 50
+
+
+def greedy_sampling(weighted_scores, decoded_tokens, sampling):
+    # eos after 24 tokens, argmax otherwise
+    if len(decoded_tokens) >= 24:
+        return torch.full(weighted_scores.shape[:-1] + (1,), SPEECH_TOKEN_SIZE, dtype=torch.long)
+    return weighted_scores[..., :SPEECH_TOKEN_SIZE].argmax(dim=-1, keepdim=True)
+
+
+class FakeFrontEnd:
+    def text_normalize(self, text, split=True, text_frontend=True):
+        return [text]
+
+    def frontend_sft(self, tts_text, spk_id):
+        return {'text': torch.tensor([[ord(c) % 100 for c in tts_text]], dtype=torch.int32),
+                'llm_embedding': torch.ones(1, 16), 'flow_embedding': torch.ones(1, 16)}
+
+
+@pytest.fixture
+def cosyvoice():
+    torch.manual_seed(0)
+    text_encoder = ConformerEncoder(input_size=64, output_size=64, attention_heads=4, linear_units=128, num_blocks=2, input_layer='linear',
+                                    pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                                    use_cnn_module=False, macaron_style=False)
+    llm = TransformerEncoder(input_size=64, output_size=64, attention_heads=4, linear_units=128, num_blocks=2, input_layer='linear_legacy',
+                             pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', static_chunk_size=1)
+    lm = TransformerLM(64, 64, 64, 100, SPEECH_TOKEN_SIZE, text_encoder, llm, greedy_sampling, spk_embed_dim=16).eval()
+    model = CosyVoiceModel(lm, FakeFlow(), FakeHift(256), False)
+    model.device = torch.device('cpu')
+    model.enable_llm_scheduler(max_batch_size=4)
+    cosyvoice = object.__new__(cosyvoice_cli.CosyVoice)
+    cosyvoice.model, cosyvoice.frontend, cosyvoice.sample_rate = model, FakeFrontEnd(), 22050
+    return cosyvoice
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_concurrent_inference_sft_share_decode_batch(cosyvoice, pipeline):
+    lm = cosyvoice.model.llm
+    decode_step, batch_sizes = lm.decode_step, []
+
+    def slow_decode_step(tokens, *args):
+        # slow enough that the second request is admitted while the first is decoding
+        batch_sizes.append(len(tokens))
+        time.sleep(0.01)
+        return decode_step(tokens, *args)
+    lm.decode_step = slow_decode_step
+    cosyvoice.pipeline = pipeline
+
+    texts = ['first request', 'second one']
+    outputs = [None] * len(texts)
+
+    def run(i):
+        outputs[i] = [o['tts_speech'] for o in cosyvoice.inference_sft(texts[i], 'spk')]
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(texts))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+
+    assert max(batch_sizes) == 2
+    # 24 tokens, 2 mel frames per token, 256 samples per frame
+    assert [sum(s.shape[1] for s in o) for o in outputs] == [24 * 2 * 256] * 2
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_decode_error_reaches_consumer(cosyvoice, stream):
+    def failing_decode_step(tokens, *args):
+        raise RuntimeError('decode failed')
+    cosyvoice.model.llm.decode_step = failing_decode_step
+    with pytest.raises(RuntimeError, match='decode failed'):
+        list(cosyvoice.inference_sft('first request', 'spk', stream=stream))
+
+
+def test_sampling_options_default_to_llm_inference(cosyvoice):
+    scheduler = cosyvoice.model.llm_scheduler
+    assert (scheduler.sampling, scheduler.max_token_text_ratio, scheduler.min_token_text_ratio) == (25, 20, 2)
+
+
+def test_shutdown_fails_active_sessions_and_joins_thread(cosyvoice):
+    lm = cosyvoice.model.llm
+    decode_step, started, resume = lm.decode_step, threading.Event(), threading.Event()
+
+    def blocking_decode_step(*args):
+        started.set()
+        resume.wait(10)
+        return decode_step(*args)
+    lm.decode_step = blocking_decode_step
+    errors = []
+
+    def run():
+        try:
+            list(cosyvoice.inference_sft('first request', 'spk'))
+        except RuntimeError as e:
+            errors.append(e)
+    consumer = threading.Thread(target=run)
+    consumer.start()
+    started.wait(10)
+    thread, stop = cosyvoice.model.llm_scheduler.thread, cosyvoice.model.llm_scheduler.stop
+    stopper = threading.Thread(target=cosyvoice.model.shutdown)
+    stopper.start()
+    stop.wait(10)
+    resume.set()
+    stopper.join(10)
+    consumer.join(10)
+    assert not thread.is_alive()
+    assert [str(e) for e in errors] == ['llm scheduler is shut down']
+
+    # the next request starts a new decoding thread
+    lm.decode_step = decode_step
+    assert sum(o['tts_speech'].shape[1] for o in cosyvoice.inference_sft('first request', 'spk')) == 24 * 2 * 256
+    cosyvoice.model.shutdown()
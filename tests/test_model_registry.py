@@ -0,0 +1,96 @@
+import threading
+import types
+
+import pytest
+import torch
+
+pytest.importorskip('folder_paths')
+model_registry = pytest.importorskip('functions.model_registry')
+
+
+class FakeCosyVoice:
+    def __init__(self, model_dir, fp16=True):
+        self.model_dir = model_dir
+        self.model = types.SimpleNamespace(llm=torch.nn.Linear(256, 256), hift=torch.nn.Linear(256, 256),
+                                           flow=torch.nn.Linear(256, 256))
+        self.model.flow.decoder = types.SimpleNamespace(estimator=torch.nn.Module())
+
+
+@pytest.fixture
+def registry(monkeypatch, tmp_path):
+    monkeypatch.setattr(model_registry, 'CosyVoicePatches', FakeCosyVoice)
+    # room for one model of three 256 x 256 fp32 linear layers
+    return model_registry.ModelRegistry(max_memory_mb=1, cold_tier=True, cold_dir=str(tmp_path))
+
+
+def test_models_in_use_are_not_offloaded(registry):
+    with registry.use('a') as a:
+        data_ptr = a.model.llm.weight.data_ptr()
+        with registry.use('b'):
+            # over budget, but 'a' is in use
+            assert [tier for _, tier in registry.loaded_models()] == ['warm', 'warm']
+        # 'b' is released first and 'a' is still in use, so 'b' goes to the cold tier
+        assert [tier for _, tier in registry.loaded_models()] == ['warm', 'cold']
+        assert a.model.llm.weight.data_ptr() == data_ptr
+
+
+def test_get_waits_for_offload(registry, monkeypatch):
+    with registry.use('a'):
+        pass
+    offload, started, finish = registry._offload, threading.Event(), threading.Event()
+
+    def slow_offload(key, entry):
+        started.set()
+        finish.wait(10)
+        offload(key, entry)
+    monkeypatch.setattr(registry, '_offload', slow_offload)
+    loader = threading.Thread(target=lambda: registry.release(registry.get('b')))
+    loader.start()
+    started.wait(10)
+    # 'a' is being offloaded, get() must not hand it out before it is restored
+    result = {}
+    getter = threading.Thread(target=lambda: result.update(model=registry.get('a')))
+    getter.start()
+    getter.join(0.2)
+    assert getter.is_alive()
+    finish.set()
+    loader.join(10)
+    getter.join(10)
+    assert dict(registry.loaded_models())[registry.make_key('a')] == 'warm'
+    registry.release(result['model'])
+
+
+def test_unload_and_evict_shut_down_models(registry):
+    shutdowns = []
+    for model_dir in ('a', 'b', 'c'):
+        with registry.use(model_dir) as cosyvoice:
+            cosyvoice.model.shutdown = lambda model_dir=model_dir: shutdowns.append(model_dir)
+    # 'a' and 'b' went to the cold tier
+    assert shutdowns == ['a', 'b']
+    registry.unload('c')
+    assert shutdowns == ['a', 'b', 'c']
+    registry.unload_all()
+    assert sorted(shutdowns) == ['a', 'a', 'b', 'b', 'c']
+
+
+def test_unload_while_in_use_waits_for_release(registry):
+    key = registry.make_key('a')
+    with registry.use('a') as a:
+        with registry.use('a'):
+            assert registry.unload('a')
+        # still in use by the outer use()
+        assert registry.loaded_models() == [(key, 'warm')]
+        a.model.llm(torch.zeros(1, 256))
+    assert registry.loaded_models() == []
+
+
+def test_unload_all_while_in_use(registry, tmp_path):
+    with registry.use('a'):
+        pass
+    with registry.use('b'):
+        # 'a' went to the cold tier when 'b' was loaded
+        assert len(list(tmp_path.iterdir())) == 1
+        assert registry.unload_all() == 2
+        assert registry.loaded_models() == [(registry.make_key('b'), 'warm')]
+        assert list(tmp_path.iterdir()) == []
+    assert registry.loaded_models() == []
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from conftest import FakeLLM, model_input
+
+
+class FailingLLM(FakeLLM):
+    @torch.inference_mode()
+    def inference(self, text, **kwargs):
+        for i in range(self.n_tokens):
+            yield i
+        raise RuntimeError('llm failed')
+
+
+def test_crossfade_inference_tensors():
+    from cosyvoice.utils.common import crossfade, fade_in_out, hamming_window
+    with torch.inference_mode():
+        fade_in, fade_out = torch.randn(1, 80, 50), torch.randn(1, 80, 30)
+    expected = fade_in_out(fade_in, fade_out, hamming_window(20, torch.device('cpu'), torch.float32))
+    output = crossfade(fade_in, fade_out, 10)
+    assert torch.allclose(output, expected)
+    assert not torch.equal(output, fade_in)
+
+
+def test_cosyvoice_stream_chunks(cosyvoice_model):
+    chunks = [o['tts_speech'] for o in cosyvoice_model.tts(**model_input(), stream=True)]
+    assert len(chunks) >= 2
+    assert all(torch.isfinite(c).all() for c in chunks)
+
+
+def test_cosyvoice2_stream_chunks(cosyvoice2_model):
+    chunks = [o['tts_speech'] for o in cosyvoice2_model.tts(**model_input(), stream=True)]
+    assert len(chunks) >= 2
+    assert all(torch.isfinite(c).all() for c in chunks)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_llm_error_reaches_consumer(cosyvoice_model, stream):
+    cosyvoice_model.llm = FailingLLM(60)
+    with pytest.raises(RuntimeError, match='llm failed'):
+        list(cosyvoice_model.tts(**model_input(), stream=stream))
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+pytest.importorskip('folder_paths')
+prompt_bundle = pytest.importorskip('functions.prompt_bundle')
+
+
+def test_upgrade_embedding_only_speaker_model():
+    embedding = torch.randn(1, 192)
+    bundle = prompt_bundle.upgrade_prompt_bundle({'flow_embedding': embedding}, sample_rate=24000)
+    assert bundle['version'] == prompt_bundle.PROMPT_BUNDLE_VERSION
+    assert bundle['sample_rate'] == 24000
+    assert bundle['embedding'] is embedding
+    assert bundle['prompt_text'].shape == (1, 0) and bundle['prompt_text'].dtype == torch.int32
+    assert bundle['prompt_speech_token'].shape == (1, 0)
+    assert bundle['prompt_speech_feat'].shape == (1, 0, 80)
+    assert all(bundle[key].tolist() == [0] for key in ('prompt_text_len', 'prompt_speech_token_len', 'prompt_speech_feat_len'))
+    assert set(prompt_bundle.PROMPT_BUNDLE_TENSOR_KEYS) < set(bundle)
+
+
+def test_upgrade_legacy_keys():
+    legacy = {'flow_embedding': torch.randn(1, 192), 'llm_embedding': torch.randn(1, 192),
+              'prompt_text': torch.ones(1, 5, dtype=torch.int32), 'prompt_text_len': torch.tensor([5], dtype=torch.int32),
+              'llm_prompt_speech_token': torch.ones(1, 30, dtype=torch.int32),
+              'llm_prompt_speech_token_len': torch.tensor([30], dtype=torch.int32),
+              'prompt_speech_feat': torch.randn(1, 60, 80), 'prompt_speech_feat_len': torch.tensor([60], dtype=torch.int32)}
+    bundle = prompt_bundle.upgrade_prompt_bundle(legacy)
+    assert bundle['sample_rate'] == 22050
+    assert bundle['embedding'] is legacy['flow_embedding']
+    assert bundle['prompt_text'] is legacy['prompt_text']
+    assert bundle['prompt_speech_token'] is legacy['llm_prompt_speech_token']
+    assert bundle['prompt_speech_token_len'] is legacy['llm_prompt_speech_token_len']
+    assert bundle['prompt_speech_feat'] is legacy['prompt_speech_feat']
+    assert 'llm_embedding' not in bundle
+
+
+def test_upgrade_current_and_newer_versions():
+    bundle = prompt_bundle.upgrade_prompt_bundle({'flow_embedding': torch.randn(1, 192)})
+    assert prompt_bundle.upgrade_prompt_bundle(bundle) is bundle
+    with pytest.raises(ValueError):
+        prompt_bundle.upgrade_prompt_bundle(dict(bundle, version=prompt_bundle.PROMPT_BUNDLE_VERSION + 1))
@@ -0,0 +1,23 @@
+import torch
+
+from cosyvoice.utils.common import nucleus_sampling
+
+
+def test_nucleus_sampling_batch_matches_rows():
+    torch.manual_seed(0)
+    weighted_scores = torch.randn(6, 40)
+    # more tied tokens than top_k, the lowest ids are kept
+    weighted_scores[:, 5:15] = 3.0
+    for seed in range(10):
+        torch.manual_seed(seed)
+        batch_ids = nucleus_sampling(weighted_scores, top_p=1.0, top_k=8)
+        torch.manual_seed(seed)
+        row_ids = torch.stack([nucleus_sampling(scores, top_p=1.0, top_k=8) for scores in weighted_scores])
+        assert torch.equal(batch_ids, row_ids)
+        assert ((batch_ids >= 5) & (batch_ids < 13)).all()
+
+
+def test_nucleus_sampling_top_k_larger_than_vocab():
+    torch.manual_seed(0)
+    top_ids = nucleus_sampling(torch.randn(3, 10), top_p=1.0, top_k=25)
+    assert top_ids.shape == (3, 1)
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+import torch
+
+pytest.importorskip('folder_paths')
+speaker_library = pytest.importorskip('functions.speaker_library')
+
+
+def make_bundle(n_tokens=30):
+    return {'version': 1, 'sample_rate': 22050,
+            'prompt_text': torch.randint(0, 100, (1, 5), dtype=torch.int32), 'prompt_text_len': torch.tensor([5], dtype=torch.int32),
+            'prompt_speech_token': torch.randint(0, 100, (1, n_tokens), dtype=torch.int32),
+            'prompt_speech_token_len': torch.tensor([n_tokens], dtype=torch.int32),
+            'prompt_speech_feat': torch.randn(1, 2 * n_tokens, 80), 'prompt_speech_feat_len': torch.tensor([2 * n_tokens], dtype=torch.int32),
+            'embedding': torch.randn(1, 192)}
+
+
+def assert_bundle_equal(bundle, expected):
+    assert bundle.keys() == expected.keys()
+    for key, value in expected.items():
+        if isinstance(value, torch.Tensor):
+            assert bundle[key].dtype == value.dtype
+            assert torch.equal(bundle[key], value)
+        else:
+            assert bundle[key] == value
+
+
+def test_round_trip(tmp_path):
+    library = speaker_library.SpeakerLibrary(str(tmp_path))
+    bundles = {'a': make_bundle(30), 'b': make_bundle(7)}
+    for name, bundle in bundles.items():
+        library.add(name, bundle)
+    assert library.names() == ['a', 'b']
+    # a second instance reads the same index and blob
+    reopened = speaker_library.SpeakerLibrary(str(tmp_path))
+    for name, bundle in bundles.items():
+        assert_bundle_equal(library.get(name), bundle)
+        assert_bundle_equal(reopened.get(name), bundle)
+
+    overwrite = make_bundle(3)
+    library.add('a', overwrite)
+    assert_bundle_equal(library.get('a'), overwrite)
+    assert library.remove('b')
+    assert not library.remove('b')
+    assert 'b' not in library
+    with pytest.raises(KeyError):
+        library.get('b')
+
+
+def test_import_legacy(tmp_path):
+    legacy_dir = tmp_path / 'legacy'
+    os.makedirs(legacy_dir / 'nested')
+    embedding = torch.randn(1, 192)
+    torch.save({'flow_embedding': embedding, 'llm_embedding': embedding}, str(legacy_dir / 'old.pt'))
+    torch.save({'flow_embedding': torch.randn(1, 192)}, str(legacy_dir / 'nested' / 'existing.pt'))
+    (legacy_dir / 'broken.pt').write_bytes(b'not a torch file')
+    library = speaker_library.SpeakerLibrary(str(tmp_path / 'library'))
+    existing = make_bundle()
+    library.add('existing', existing)
+
+    assert library.import_legacy(str(legacy_dir)) == 1
+    assert library.names() == ['existing', 'old']
+    assert_bundle_equal(library.get('existing'), existing)
+    old = library.get('old')
+    assert torch.equal(old['embedding'], embedding)
+    assert old['prompt_speech_token'].shape == (1, 0)
+    assert library.import_legacy(str(legacy_dir)) == 0
+
+
+def test_compact_then_load(tmp_path):
+    library = speaker_library.SpeakerLibrary(str(tmp_path))
+    bundles = {name: make_bundle() for name in ('a', 'b', 'c')}
+    for name, bundle in bundles.items():
+        library.add(name, bundle)
+    library.add('a', bundles['a'])
+    library.remove('b')
+    loaded = library.get('c')
+    old_size = os.path.getsize(tmp_path / 'speakers.0.bin')
+
+    library.compact()
+    assert sorted(os.listdir(tmp_path)) == ['index.json', 'speakers.1.bin']
+    assert os.path.getsize(tmp_path / 'speakers.1.bin') < old_size
+    # views returned before compact() stay valid, new loads read the new blob
+    assert_bundle_equal(loaded, bundles['c'])
+    assert library.names() == ['a', 'c']
+    for name in ('a', 'c'):
+        assert_bundle_equal(library.get(name), bundles[name])
+        assert_bundle_equal(speaker_library.SpeakerLibrary(str(tmp_path)).get(name), bundles[name])
+
+
+def test_compact_keeps_blob_that_cannot_be_removed(tmp_path, monkeypatch):
+    library = speaker_library.SpeakerLibrary(str(tmp_path))
+    bundle = make_bundle()
+    library.add('a', bundle)
+    library.get('a')
+    remove = os.remove
+
+    def mapped_remove(path):
+        # like Windows, a mapped file cannot be removed
+        raise PermissionError(path)
+    monkeypatch.setattr(os, 'remove', mapped_remove)
+    library.compact()
+    assert sorted(os.listdir(tmp_path)) == ['index.json', 'speakers.0.bin', 'speakers.1.bin']
+    assert_bundle_equal(library.get('a'), bundle)
+
+    monkeypatch.setattr(os, 'remove', remove)
+    library.compact()
+    assert sorted(os.listdir(tmp_path)) == ['index.json', 'speakers.2.bin']
+    assert_bundle_equal(speaker_library.SpeakerLibrary(str(tmp_path)).get('a'), bundle)
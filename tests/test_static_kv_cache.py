@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from cosyvoice.transformer.encoder import TransformerEncoder
+
+
+@pytest.mark.parametrize('pos_enc_layer_type,selfattention_layer_type', [('rel_pos_espnet', 'rel_selfattn'), ('abs_pos', 'selfattn')])
+def test_forward_chunk_static_matches_forward_chunk(pos_enc_layer_type, selfattention_layer_type):
+    torch.manual_seed(0)
+    encoder = TransformerEncoder(input_size=32, output_size=32, attention_heads=4, linear_units=64, num_blocks=2,
+                                 input_layer='linear_legacy', pos_enc_layer_type=pos_enc_layer_type,
+                                 selfattention_layer_type=selfattention_layer_type, static_chunk_size=1).eval()
+    prompt, steps = torch.randn(1, 12, 32), torch.randn(10, 1, 1, 32)
+    with torch.inference_mode():
+        kv_cache = encoder.new_static_cache(prompt.size(1) + len(steps), prompt.device, prompt.dtype)
+        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0)), torch.zeros((0, 0, 0, 0))
+        prefill_mask = torch.tril(torch.ones((1, prompt.size(1), prompt.size(1)))).to(torch.bool)
+        offset, xs, att_mask = 0, prompt, prefill_mask
+        for step in range(len(steps) + 1):
+            expected, att_cache, cnn_cache = encoder.forward_chunk(xs, offset=offset, required_cache_size=-1, att_cache=att_cache,
+                                                                   cnn_cache=cnn_cache, att_mask=att_mask)
+            ys = encoder.forward_chunk_static(xs, offset=offset, kv_cache=kv_cache, att_mask=att_mask)
+            assert torch.allclose(ys, expected, atol=1e-5)
+            if step < len(steps):
+                offset, xs, att_mask = offset + xs.size(1), steps[step], torch.ones((0, 0, 0), dtype=torch.bool)
+        # the cache is filled exactly
+        with pytest.raises(AssertionError):
+            encoder.forward_chunk_static(xs, offset=offset + 1, kv_cache=kv_cache)
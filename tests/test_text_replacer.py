@@ -0,0 +1,55 @@
+import os
+import random
+
+from functions.text_replacer import AhoCorasickReplacer, get_text_replacer
+
+
+def brute_force_replace(rules, text):
+    replacements = {}
+    for old, new in rules:
+        if old and old not in replacements:
+            replacements[old] = new
+    pieces, position = [], 0
+    while position < len(text):
+        old = max((old for old in replacements if text.startswith(old, position)), key=len, default=None)
+        if old is None:
+            pieces.append(text[position])
+            position += 1
+        else:
+            pieces.append(replacements[old])
+            position += len(old)
+    return "".join(pieces)
+
+
+def test_replace_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(200):
+        rules = [("".join(rng.choices("abc", k=rng.randint(1, 4))), "".join(rng.choices("XY", k=rng.randint(0, 3))))
+                 for _ in range(rng.randint(1, 8))]
+        text = "".join(rng.choices("abcd", k=rng.randint(0, 30)))
+        assert AhoCorasickReplacer(rules).replace(text) == brute_force_replace(rules, text)
+
+
+def test_replace_leftmost_longest_and_first_rule_wins():
+    replacer = AhoCorasickReplacer([("行", "xing2"), ("银行", "yin2hang2"), ("行", "hang2"), ("", "empty")])
+    assert replacer.replace("银行行长") == "yin2hang2xing2长"
+    # replaced text is not matched again
+    assert AhoCorasickReplacer([("a", "b"), ("b", "c")]).replace("ab") == "bc"
+
+
+def test_get_text_replacer_reloads_changed_file(tmp_path):
+    path = tmp_path / "rules.txt"
+    path.write_text("重,chong2\n", encoding="utf-8")
+    replacer = get_text_replacer(str(path))
+    assert get_text_replacer(str(path)) is replacer
+    assert replacer.replace("重新") == "chong2新"
+
+    # same size, newer modification time
+    path.write_text("重,zhong4\n", encoding="utf-8")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert get_text_replacer(str(path)).replace("重新") == "zhong4新"
+
+    # different size
+    path.write_text("重,zhong4\n新,xin1\n", encoding="utf-8")
+    assert get_text_replacer(str(path)).replace("重新") == "zhong4xin1"
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import torch
+
+from functions.time_stretch import time_stretch, wsola
+
+SAMPLE_RATE = 22050
+
+
+def dominant_frequency(samples):
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    return np.fft.rfftfreq(len(samples), 1 / SAMPLE_RATE)[np.argmax(spectrum)]
+
+
+@pytest.mark.parametrize('speed', [0.5, 0.8, 1.25, 1.5, 2.0])
+def test_wsola_length_and_pitch(speed):
+    t = np.arange(2 * SAMPLE_RATE) / SAMPLE_RATE
+    # a 220 Hz tone that switches to 440 Hz half way
+    samples = np.where(t < 1, np.sin(2 * np.pi * 220 * t), np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+    output = wsola(samples, speed)
+    assert output.dtype == np.float32
+    assert len(output) == int(round(len(samples) / speed))
+    # the switch moves to 1 / speed seconds, the pitch stays
+    switch = int(SAMPLE_RATE / speed)
+    window = int(0.3 * SAMPLE_RATE)
+    assert abs(dominant_frequency(output[switch - window - 2048:switch - 2048]) - 220) < 10
+    assert abs(dominant_frequency(output[switch + 2048:switch + window + 2048]) - 440) < 10
+
+
+def test_time_stretch_keeps_channels():
+    speech = torch.randn(2, SAMPLE_RATE)
+    output = time_stretch(speech, 1.5)
+    assert output.shape == (2, int(round(SAMPLE_RATE / 1.5)))
+    assert time_stretch(speech, 1.0) is speech
+    assert time_stretch(speech[0], 0.5).shape == (2 * SAMPLE_RATE,)
+    with pytest.raises(ValueError):
+        time_stretch(speech, 0)
@@ -0,0 +1,75 @@
+# 测量 LLM 逐 token 解码时注意力掩码的开销：每步重新构建 tril 掩码 vs 仅预填充时构建、单 token 步使用空掩码。
+#
+# 用法(在插件目录下运行):
+#   python tools/benchmark_attention_mask.py --model_dir /path/to/CosyVoice-300M-SFT
+#   python tools/benchmark_attention_mask.py --model_dir /path/to/CosyVoice-300M-SFT --prompt_len 100 300 600 --steps 200
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+sys.path.append(os.path.join(node_root, 'third_party', 'matcha_tts'))
+
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='measure per-step cost of the llm attention mask during decoding')
+    parser.add_argument('--model_dir', required=True, help='local CosyVoice model directory')
+    parser.add_argument('--prompt_len', type=int, nargs='+', default=[100, 300, 600], help='prompt lengths fed as prefill')
+    parser.add_argument('--steps', type=int, default=200, help='number of timed decoding steps')
+    return parser.parse_args()
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def decode(llm, lm_input, steps, rebuild_mask):
+    """解码 steps 步，返回每步平均耗时(毫秒)。rebuild_mask 为 True 时按旧实现每步构建 tril 掩码。"""
+    device = lm_input.device
+    prefill_mask = torch.tril(torch.ones((1, lm_input.size(1), lm_input.size(1)), device=device)).to(torch.bool)
+    step_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=device)
+    att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=device), torch.zeros((0, 0, 0, 0), device=device)
+    y_pred, att_cache, cnn_cache = llm.forward_chunk(lm_input, offset=0, required_cache_size=-1,
+                                                     att_cache=att_cache, cnn_cache=cnn_cache, att_mask=prefill_mask)
+    offset = lm_input.size(1)
+    xs = y_pred[:, -1:]
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        if rebuild_mask:
+            att_mask = torch.tril(torch.ones((1, xs.size(1), xs.size(1)), device=device)).to(torch.bool)
+        else:
+            att_mask = step_mask
+        y_pred, att_cache, cnn_cache = llm.forward_chunk(xs, offset=offset, required_cache_size=-1,
+                                                         att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+        offset += 1
+        xs = y_pred[:, -1:]
+    sync(device)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    args = get_args()
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    model = cosyvoice.model
+    llm = model.llm.llm
+    for prompt_len in args.prompt_len:
+        lm_input = torch.randn(1, prompt_len, model.llm.llm_input_size, device=model.device)
+        # 预热
+        decode(llm, lm_input, 10, True)
+        rebuild = decode(llm, lm_input, args.steps, True)
+        trivial = decode(llm, lm_input, args.steps, False)
+        print('prompt {:4d}: rebuild tril {:.3f} ms/step  fake mask {:.3f} ms/step  saving {:.3f} ms/step ({:.1f}%)'.format(
+            prompt_len, rebuild, trivial, rebuild - trivial, (rebuild - trivial) / rebuild * 100))
+
+
+if __name__ == '__main__':
+    main()
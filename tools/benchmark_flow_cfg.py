@@ -0,0 +1,85 @@
+# 比较 classifier-free guidance 调度(只在部分步数上做引导)的 flow 耗时和梅尔谱误差。
+# 误差为与全部步数引导结果的平均 L1 距离，所有配置使用相同的语音 token 和初始噪声(固定种子)。
+# 区间 "start,end" 表示第 k 步在 start <= k / n_timesteps < end 时引导，未引导的步以 batch 1 运行估计器。
+#
+# 用法(在插件目录下运行):
+#   python tools/benchmark_flow_cfg.py --model_dir /path/to/CosyVoice-300M-SFT
+#   python tools/benchmark_flow_cfg.py --model_dir /path/to/CosyVoice-300M-SFT --intervals 0,0.5 0,0.3 0.2,0.6 --solver heun --n_timesteps 4
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+sys.path.append(os.path.join(node_root, 'third_party', 'matcha_tts'))
+
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='measure time and mel distance of classifier-free guidance schedules')
+    parser.add_argument('--model_dir', required=True, help='local CosyVoice sft model directory')
+    parser.add_argument('--speaker', default='中文女', help='pretrained speaker id')
+    parser.add_argument('--text', default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐。',
+                        help='text to synthesize')
+    parser.add_argument('--intervals', nargs='+', default=['0,0.8', '0,0.6', '0,0.5', '0,0.3', '0.2,0.6', '0,0'],
+                        help='guided fraction of the steps as start,end')
+    parser.add_argument('--solver', default='euler', help='flow matching solver')
+    parser.add_argument('--n_timesteps', type=int, default=10, help='flow matching steps')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per configuration')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the initial noise')
+    return parser.parse_args()
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def flow_time(model, model_input, speech_token, repeat, seed, **flow_options):
+    """返回平均耗时(秒)和最后一次的梅尔谱。"""
+    sync(model.device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        set_all_random_seed(seed)
+        tts_mel = model.token2mel(token=speech_token,
+                                  prompt_token=model_input.get('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                  prompt_feat=model_input.get('prompt_speech_feat', torch.zeros(1, 0, 80)),
+                                  embedding=model_input['flow_embedding'],
+                                  flow_options=flow_options)
+    sync(model.device)
+    return (time.perf_counter() - start) / repeat, tts_mel
+
+
+def main():
+    args = get_args()
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    model = cosyvoice.model
+    model_input = cosyvoice.frontend.frontend_sft(cosyvoice.frontend.text_normalize(args.text, split=False), args.speaker)
+    set_all_random_seed(args.seed)
+    speech_token = torch.tensor(list(model.llm_generate(model_input['text'],
+                                                        model_input.get('prompt_text', torch.zeros(1, 0, dtype=torch.int32)),
+                                                        model_input.get('llm_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                                        model_input.get('llm_embedding', torch.zeros(0, 192))))).unsqueeze(dim=0)
+    options = {'solver': args.solver, 'n_timesteps': args.n_timesteps}
+    # 预热
+    flow_time(model, model_input, speech_token, 1, args.seed, **options)
+    full, reference = flow_time(model, model_input, speech_token, args.repeat, args.seed, **options)
+    print('{} speech tokens, {} mel frames, {} {} steps, cfg rate {}'.format(
+        speech_token.shape[1], reference.shape[2], args.solver, args.n_timesteps, model.flow.decoder.inference_cfg_rate))
+    print('{:>10s} {:>7s} {:>10s} {:>8s} {:>10s}'.format('interval', 'guided', 'time(ms)', 'speedup', 'mel L1'))
+    print('{:>10s} {:>7d} {:>10.1f} {:>8.2f} {:>10.4f}'.format('0,1', args.n_timesteps, full * 1000, 1.0, 0.0))
+    for interval in args.intervals:
+        cfg_interval = tuple(float(i) for i in interval.split(','))
+        guided = sum(model.flow.decoder.cfg_schedule(args.n_timesteps, cfg_interval))
+        elapsed, tts_mel = flow_time(model, model_input, speech_token, args.repeat, args.seed, cfg_interval=cfg_interval, **options)
+        print('{:>10s} {:>7d} {:>10.1f} {:>8.2f} {:>10.4f}'.format(
+            interval, guided, elapsed * 1000, full / elapsed, (tts_mel - reference).abs().mean().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# 测量 flow 解码器注意力掩码的开销：每次估计器调用在每个模块内重新构建掩码 vs 每次 ODE 求解只构建一次。
+# 输入为随机语音 token，时长由 --duration 指定(默认 10 秒)，两种方式使用相同的初始噪声。
+#
+# 用法(在插件目录下运行):
+#   python tools/benchmark_flow_masks.py --model_dir /path/to/CosyVoice-300M-SFT
+#   python tools/benchmark_flow_masks.py --model_dir /path/to/CosyVoice2-0.5B --cosyvoice2 --duration 5 10 20 --repeat 5
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+sys.path.append(os.path.join(node_root, 'third_party', 'matcha_tts'))
+
+from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='measure flow time with per call and per solve decoder attention masks')
+    parser.add_argument('--model_dir', required=True, help='local CosyVoice or CosyVoice2 model directory')
+    parser.add_argument('--cosyvoice2', action='store_true', help='load model_dir as CosyVoice2 (causal flow with chunk masks)')
+    parser.add_argument('--duration', type=float, nargs='+', default=[10], help='utterance durations in seconds')
+    parser.add_argument('--n_timesteps', type=int, default=10, help='flow matching steps')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per configuration')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of tokens and noise')
+    return parser.parse_args()
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def flow_time(model, token, embedding, n_timesteps, repeat, seed):
+    """返回平均耗时(秒)和最后一次的梅尔谱。"""
+    sync(model.device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        set_all_random_seed(seed)
+        tts_mel = model.token2mel(token=token,
+                                  prompt_token=torch.zeros(1, 0, dtype=torch.int32),
+                                  prompt_feat=torch.zeros(1, 0, 80),
+                                  embedding=embedding,
+                                  flow_options={'n_timesteps': n_timesteps})
+    sync(model.device)
+    return (time.perf_counter() - start) / repeat, tts_mel
+
+
+def main():
+    args = get_args()
+    if args.cosyvoice2:
+        cosyvoice = CosyVoice2(args.model_dir, load_jit=False, load_trt=False)
+    else:
+        cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    model = cosyvoice.model
+    cfm = model.flow.decoder
+    embedding = torch.randn(1, 192)
+    for duration in args.duration:
+        set_all_random_seed(args.seed)
+        token = torch.randint(0, model.flow.vocab_size, (1, int(duration * model.flow.input_frame_rate)), dtype=torch.int32)
+        # 预热
+        flow_time(model, token, embedding, 2, 1, args.seed)
+        shared, shared_mel = flow_time(model, token, embedding, args.n_timesteps, args.repeat, args.seed)
+        # 实例属性遮蔽 ConditionalCFM.attention_masks，解码器退回到每次调用自行构建掩码
+        cfm.attention_masks = lambda x, mask: None
+        try:
+            per_call, per_call_mel = flow_time(model, token, embedding, args.n_timesteps, args.repeat, args.seed)
+        finally:
+            del cfm.attention_masks
+        print('{:5.1f}s speech, {} steps: per call masks {:.1f} ms  per solve masks {:.1f} ms  saving {:.1f}%  max mel diff {:.2e}'.format(
+            duration, args.n_timesteps, per_call * 1000, shared * 1000, (per_call - shared) / per_call * 100,
+            (per_call_mel - shared_mel).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# 比较 flow matching 各 ODE 求解器与步数的耗时和梅尔谱误差，用于选择 config.FLOW_QUALITY_PRESETS。
+# 误差为与高步数 euler 参考结果的平均 L1 距离，所有配置使用相同的语音 token 和初始噪声(固定种子)。
+#
+# 用法(在插件目录下运行):
+#   python tools/benchmark_flow_solvers.py --model_dir /path/to/CosyVoice-300M-SFT
+#   python tools/benchmark_flow_solvers.py --model_dir /path/to/CosyVoice-300M-SFT --solvers euler heun --steps 2 4 8 --ref_steps 64
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+sys.path.append(os.path.join(node_root, 'third_party', 'matcha_tts'))
+
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.flow.flow_matching import ConditionalCFM
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='measure time and mel distance of flow matching solvers and step counts')
+    parser.add_argument('--model_dir', required=True, help='local CosyVoice sft model directory')
+    parser.add_argument('--speaker', default='中文女', help='pretrained speaker id')
+    parser.add_argument('--text', default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐。',
+                        help='text to synthesize')
+    parser.add_argument('--solvers', nargs='+', default=list(ConditionalCFM.solvers), help='solvers to compare')
+    parser.add_argument('--steps', type=int, nargs='+', default=[2, 3, 4, 5, 6, 8, 10], help='n_timesteps to compare')
+    parser.add_argument('--ref_steps', type=int, default=64, help='n_timesteps of the euler reference')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per configuration')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the initial noise')
+    return parser.parse_args()
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def token2mel(model, model_input, speech_token, seed, **flow_options):
+    set_all_random_seed(seed)
+    return model.token2mel(token=speech_token,
+                           prompt_token=model_input.get('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                           prompt_feat=model_input.get('prompt_speech_feat', torch.zeros(1, 0, 80)),
+                           embedding=model_input['flow_embedding'],
+                           flow_options=flow_options)
+
+
+def main():
+    args = get_args()
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    model = cosyvoice.model
+    model_input = cosyvoice.frontend.frontend_sft(cosyvoice.frontend.text_normalize(args.text, split=False), args.speaker)
+    set_all_random_seed(args.seed)
+    speech_token = torch.tensor(list(model.llm_generate(model_input['text'],
+                                                        model_input.get('prompt_text', torch.zeros(1, 0, dtype=torch.int32)),
+                                                        model_input.get('llm_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                                        model_input.get('llm_embedding', torch.zeros(0, 192))))).unsqueeze(dim=0)
+    reference = token2mel(model, model_input, speech_token, args.seed, solver='euler', n_timesteps=args.ref_steps)
+    print('{} speech tokens, {} mel frames, reference euler {} steps'.format(speech_token.shape[1], reference.shape[2], args.ref_steps))
+    # 预热
+    token2mel(model, model_input, speech_token, args.seed)
+    print('{:>14s} {:>6s} {:>10s} {:>10s}'.format('solver', 'steps', 'time(ms)', 'mel L1'))
+    for solver in args.solvers:
+        for n_timesteps in args.steps:
+            sync(model.device)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                tts_mel = token2mel(model, model_input, speech_token, args.seed, solver=solver, n_timesteps=n_timesteps)
+            sync(model.device)
+            elapsed = (time.perf_counter() - start) / args.repeat * 1000
+            distance = (tts_mel - reference).abs().mean().item()
+            print('{:>14s} {:>6d} {:>10.1f} {:>10.4f}'.format(solver, n_timesteps, elapsed, distance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# 对比进程内 WSOLA 变速与逐块 ffmpeg atempo 变速的耗时和质量。
+#
+# 用法(在插件目录下运行):
+#   python tools/benchmark_speed_change.py --speed 1.25 --chunks 20
+#   python tools/benchmark_speed_change.py --wav sample.wav --speed 0.8
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+
+from functions.time_stretch import time_stretch
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark wsola time stretch against ffmpeg atempo')
+    parser.add_argument('--wav', default='', help='input wav file, a synthetic voiced signal is used if empty')
+    parser.add_argument('--sample_rate', type=int, default=22050, help='sample rate of the synthetic signal')
+    parser.add_argument('--duration', type=float, default=30.0, help='duration in seconds of the synthetic signal')
+    parser.add_argument('--speed', type=float, default=1.25, help='playback speed')
+    parser.add_argument('--chunks', type=int, default=20, help='number of chunks sent to ffmpeg, like a streaming generate_audio')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs')
+    return parser.parse_args()
+
+
+def synthetic_speech(sample_rate, duration):
+    # 带颤音和音节包络的谐波信号，近似浊音
+    t = np.arange(int(sample_rate * duration)) / sample_rate
+    f0 = 140 + 20 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    signal = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2
+    return (0.2 * signal * envelope).astype(np.float32)
+
+
+def ffmpeg_speed_change(samples, speed, sample_rate, chunks):
+    import ffmpeg
+    outputs = []
+    for chunk in np.array_split(samples, chunks):
+        raw_audio = (chunk * 32768).astype(np.int16).tobytes()
+        stream = ffmpeg.input('pipe:', format='s16le', acodec='pcm_s16le', ar=str(sample_rate), ac=1).filter('atempo', speed)
+        out, _ = stream.output('pipe:', format='s16le', acodec='pcm_s16le').run(input=raw_audio, capture_stdout=True, capture_stderr=True)
+        outputs.append(np.frombuffer(out, np.int16).astype(np.float32) / 32768)
+    return np.concatenate(outputs)
+
+
+def log_spectrum(samples, n_fft=1024):
+    # 长时平均对数谱，对两种实现的帧对齐差异不敏感
+    frames = np.lib.stride_tricks.sliding_window_view(samples, n_fft)[::n_fft // 2]
+    spec = np.abs(np.fft.rfft(frames * np.hanning(n_fft), axis=1)) ** 2
+    return 10 * np.log10(spec.mean(axis=0) + 1e-10)
+
+
+def spectral_distance(samples, reference, dynamic_range=60):
+    # 低于参考谱峰值 dynamic_range dB 的部分截断，避免几乎无能量的频段主导结果
+    floor = reference.max() - dynamic_range
+    spectrum = np.maximum(log_spectrum(samples), floor)
+    return np.sqrt(np.mean((spectrum - np.maximum(reference, floor)) ** 2))
+
+
+def timed(fn, repeat):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    args = get_args()
+    if args.wav:
+        import torchaudio
+        speech, sample_rate = torchaudio.load(args.wav)
+        samples = speech.mean(dim=0).numpy().astype(np.float32)
+    else:
+        sample_rate = args.sample_rate
+        samples = synthetic_speech(sample_rate, args.duration)
+    expected_len = len(samples) / args.speed
+    print('input {:.2f}s at {} Hz, speed {}'.format(len(samples) / sample_rate, sample_rate, args.speed))
+
+    reference = log_spectrum(samples)
+    wsola_time, wsola_out = timed(lambda: time_stretch(torch.from_numpy(samples), args.speed).numpy(), args.repeat)
+    print('wsola : {:8.1f} ms  length error {:+.2%}  log-spectral distance {:.2f} dB'.format(
+        wsola_time * 1000, len(wsola_out) / expected_len - 1, spectral_distance(wsola_out, reference)))
+    try:
+        ffmpeg_time, ffmpeg_out = timed(lambda: ffmpeg_speed_change(samples, args.speed, sample_rate, args.chunks), args.repeat)
+    except (ImportError, FileNotFoundError) as e:
+        print('ffmpeg: unavailable ({})'.format(e))
+        return
+    print('ffmpeg: {:8.1f} ms  length error {:+.2%}  log-spectral distance {:.2f} dB  ({} chunks)'.format(
+        ffmpeg_time * 1000, len(ffmpeg_out) / expected_len - 1, spectral_distance(ffmpeg_out, reference), args.chunks))
+    print('speedup {:.1f}x'.format(ffmpeg_time / wsola_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# 测量流式合成的首包延迟(从请求开始到第一块音频输出)。
+#
+# 用法(在插件目录下运行):
+#   python tools/benchmark_stream_latency.py --model_dir /path/to/CosyVoice-300M-SFT
+#   python tools/benchmark_stream_latency.py --model_dir /path/to/CosyVoice-300M-SFT --speaker 中文男 --repeat 10
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+node_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(node_root)
+sys.path.append(os.path.join(node_root, 'third_party', 'matcha_tts'))
+
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='measure first packet latency of streaming sft inference')
+    parser.add_argument('--model_dir', required=True, help='local CosyVoice sft model directory')
+    parser.add_argument('--speaker', default='中文女', help='pretrained speaker id')
+    parser.add_argument('--text', default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐。',
+                        help='text to synthesize')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs, one warmup run is added')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    total = []
+    for _ in range(args.repeat + 1):
+        start = time.perf_counter()
+        for _ in cosyvoice.inference_sft(args.text, args.speaker, stream=True):
+            pass
+        total.append(time.perf_counter() - start)
+    # 丢弃预热轮
+    first_packet = np.array(list(cosyvoice.model.first_packet_latency)[1:]) * 1000
+    total = np.array(total[1:]) * 1000
+    print('first packet: mean {:.1f} ms  min {:.1f} ms  max {:.1f} ms'.format(first_packet.mean(), first_packet.min(), first_packet.max()))
+    print('total       : mean {:.1f} ms'.format(total.mean()))
+
+
+if __name__ == '__main__':
+    main()